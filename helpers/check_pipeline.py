@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+'''
+Check `ngless.pipeline` against a real ngless
+
+Runs trim -> map -> mapstats on the files in `test-data`, first one script
+after the other and then as a `Pipeline`, and checks that both give the same
+statistics. Requires ngless in the PATH.
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+
+from ngless import NGLess
+from ngless.pipeline import Pipeline
+
+TIMEOUT = 600
+
+def build_stages(data, odir):
+    trim = NGLess.NGLess('0.8')
+    e = trim.env
+    e.input = trim.fastq_(os.path.join(data, 'input-forward.fq'), encoding='{33}')
+
+    @trim.preprocess_(e.input, using='r')
+    def proc(bk):
+        bk.r = trim.substrim_(bk.r, min_quality=20)
+        trim.if_(trim.len_(bk.r) < 10,
+                trim.discard_)
+    trim.write_(e.input, ofile=os.path.join(odir, 'trimmed.fq'))
+
+    mapping = NGLess.NGLess('0.8')
+    e = mapping.env
+    # An explicit encoding lets ngless read the intermediate file in a
+    # single pass, so that it is streamed through a FIFO
+    e.input = mapping.fastq_(os.path.join(odir, 'trimmed.fq'), encoding='{33}')
+    e.mapped = mapping.map_(e.input, fafile=os.path.join(data, 'reference.fna'))
+    mapping.write_(e.mapped, ofile=os.path.join(odir, 'mapped.sam'))
+
+    stats = NGLess.NGLess('0.8')
+    e = stats.env
+    e.mapped = stats.samfile_(os.path.join(odir, 'mapped.sam'))
+    stats.write_(stats.mapstats_(e.mapped), ofile=os.path.join(odir, 'output.stats'))
+    return [trim, mapping, stats]
+
+def main():
+    data = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'test-data'))
+    tdir = tempfile.mkdtemp(prefix='nglesspy-check-pipeline-')
+    try:
+        sequential = os.path.join(tdir, 'sequential')
+        concurrent = os.path.join(tdir, 'pipeline')
+        os.mkdir(sequential)
+        os.mkdir(concurrent)
+        for sc in build_stages(data, sequential):
+            sc.run(auto_install=False, verbose=False, history=False)
+        Pipeline(build_stages(data, concurrent)).run(auto_install=False, verbose=False, timeout=TIMEOUT)
+
+        if os.path.exists(os.path.join(concurrent, 'trimmed.fq')):
+            print('FAIL: trimmed.fq was written to disk instead of being streamed')
+            return 1
+        with open(os.path.join(sequential, 'output.stats')) as a, \
+                open(os.path.join(concurrent, 'output.stats')) as b:
+            # The statistics may name the input file
+            if a.read().replace(sequential, '') != b.read().replace(concurrent, ''):
+                print('FAIL: sequential and pipelined runs differ')
+                return 1
+        print('OK')
+        return 0
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
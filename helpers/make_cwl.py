@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# make_cwl.py -- generate cwl/ngless-*.cwl from the argparse definitions of
+# the scripts in ngless/bin
+
+import sys
+import argparse
+import importlib
+from os import path
+
+BASEDIR = path.abspath(path.join(path.dirname(__file__), '..'))
+sys.path.insert(0, BASEDIR)
+
+TOOLS = ['count', 'map', 'mapstats', 'select', 'trim', 'unique']
+
+# Options which are passed as files (all others are strings/numbers/flags)
+FILE_OPTIONS = set(['input', 'input_reverse', 'input_singles', 'fasta'])
+
+# Options which make no sense in a CWL step
+SKIP_OPTIONS = set(['help', 'auto_install', 'preview', 'shard_dir'])
+
+DEFAULT_OUTPUT = {
+    'count': 'count-output.bam',
+    'map': 'map-output.bam',
+    'mapstats': 'output.stats',
+    'select': 'select-output.bam',
+    'trim': 'trim-output.fq',
+    'unique': 'unique-output.fq',
+}
+
+# Minimum RAM (in MiB) requested from the CWL runner
+RAM_MIN = {
+    'map': 8192,
+    'count': 4096,
+}
+DEFAULT_RAM_MIN = 2048
+
+HEADER = '''#!/usr/bin/env cwl-runner
+# This tool description was generated by helpers/make_cwl.py from the
+# command line options of ngless/bin/ngless_{tool}.py (do not edit by hand)
+
+cwlVersion: v1.0
+
+class: CommandLineTool
+baseCommand: ['ngless-{tool}.py']
+
+'''
+
+FOOTER = '''outputs:
+  output_file:
+    type: File
+    outputBinding:
+      glob: $(inputs.output)
+'''
+
+
+def load_ngl_types():
+    '''Returns a dictionary mapping sets of symbols to type names'''
+    types = {}
+    name = None
+    with open(path.join(BASEDIR, 'cwl', 'ngl-types.yml')) as ifile:
+        for line in ifile:
+            line = line.strip()
+            if line.startswith('name:'):
+                name = line.split(':', 1)[1].strip()
+            elif line.startswith('symbols:'):
+                symbols = line.split(':', 1)[1].strip().strip('[]')
+                types[frozenset(s.strip().strip("'\"") for s in symbols.split(','))] = name
+    return types
+
+
+def cwl_type(action, ngl_types):
+    if isinstance(action, argparse._StoreTrueAction):
+        return 'boolean'
+    if action.dest in FILE_OPTIONS:
+        return 'File'
+    if action.choices:
+        name = ngl_types.get(frozenset(action.choices))
+        if name is None:
+            raise ValueError("No type in ngl-types.yml for choices {}".format(action.choices))
+        base = 'ngl-types.yml#' + name
+    elif action.type is int:
+        base = 'int'
+    else:
+        base = 'string'
+    if action.nargs == '+':
+        base += '[]'
+    return base
+
+
+def generate(tool, ngl_types):
+    module = importlib.import_module('ngless.bin.ngless_{}'.format(tool))
+    parser = module.build_parser()
+    inputs = []
+    uses_types = False
+    for action in parser._actions:
+        if action.dest in SKIP_OPTIONS:
+            continue
+        ctype = cwl_type(action, ngl_types)
+        uses_types = uses_types or ctype.startswith('ngl-types.yml')
+        default = action.default
+        if action.dest == 'output':
+            default = DEFAULT_OUTPUT[tool]
+        elif not action.required:
+            ctype += '?'
+        lines = ['  {}:'.format(action.dest),
+                 '    type: {}'.format(ctype)]
+        if default is not None:
+            lines.append('    default: {}'.format(default))
+        lines.append('    doc: {}'.format(action.help))
+        lines.append('    inputBinding:')
+        lines.append('      prefix: {}'.format(action.option_strings[-1]))
+        inputs.append('\n'.join(lines) + '\n')
+
+    out = [HEADER.format(tool=tool)]
+    if uses_types:
+        out.append('requirements:\n')
+        out.append('- $import: ngl-types.yml\n\n')
+    out.append('hints:\n')
+    out.append('- class: ResourceRequirement\n')
+    out.append('  coresMin: $(inputs.threads)\n')
+    out.append('  ramMin: {}\n'.format(RAM_MIN.get(tool, DEFAULT_RAM_MIN)))
+    out.append('\ndoc: |\n  {}\n\n'.format(parser.description))
+    out.append('inputs:\n\n')
+    out.append('\n'.join(inputs))
+    out.append('\n')
+    out.append(FOOTER)
+    return ''.join(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate CWL tool descriptions for the ngless-*.py scripts')
+    parser.add_argument('-o', '--output-dir', default=path.join(BASEDIR, 'cwl'),
+                        help='Where to write the .cwl files')
+    args = parser.parse_args()
+    ngl_types = load_ngl_types()
+    for tool in TOOLS:
+        ofile = path.join(args.output_dir, 'ngless-{}.cwl'.format(tool))
+        with open(ofile, 'w') as output:
+            output.write(generate(tool, ngl_types))
+        print("Wrote {}".format(ofile))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: ai sts=4 et sw=4
@@ -47,7 +47,7 @@ This is equivalent to the NGLess script
 '''
 
 
-import os
+import time
 
 class NGLessExpression(object):
     def generate(self, indent=''):
@@ -154,6 +154,16 @@ def encode_value(val):
     return str(val)
 
 
+def _call_site():
+    '''Return `(filename, lineno)` of the closest caller outside this module'''
+    import sys
+    f = sys._getframe(1)
+    while f is not None and f.f_globals is globals():
+        f = f.f_back
+    if f is None:
+        return None
+    return (f.f_code.co_filename, f.f_lineno)
+
 class FunctionCall(NGLessValue):
     def __init__(self, fname, arg, kwargs, block):
         if isinstance(arg, str) or isinstance(arg, int):
@@ -162,6 +172,7 @@ class FunctionCall(NGLessValue):
         self.arg = arg
         self.kwargs = kwargs
         self.block = block
+        self.call_site = _call_site()
 
     def generate(self, indent=''):
         block_code = ''
@@ -179,6 +190,7 @@ class PairedCalled(NGLessValue):
         self.arg2 = arg2
         self.kwargs = kwargs
         self.block = block
+        self.call_site = _call_site()
 
     def generate(self, indent=''):
         block_code = ''
@@ -217,7 +229,10 @@ class NGLessEnvironment(object):
         self._nglenv__vars = {}
 
     def __getattr__(self, name):
-        return self._nglenv__vars[name]
+        variables = self.__dict__.get('_nglenv__vars', {})
+        if name not in variables:
+            raise AttributeError("Unknown variable '{}'".format(name))
+        return variables[name]
 
     def _nglenv__create_var(self, name):
         e = NGLessVariable(name)
@@ -268,17 +283,113 @@ class FunctionCallWithBlock(object):
         self.add_expression(Assignment(var, expr))
 
 
+def _children(e):
+    '''Sub-expressions of an expression'''
+    if isinstance(e, Assignment):
+        return [e.var, e.expression]
+    if isinstance(e, FunctionCall):
+        return [e.arg] + list(e.kwargs.values()) + [e.block]
+    if isinstance(e, PairedCalled):
+        return [e.arg1, e.arg2] + list(e.kwargs.values()) + [e.block]
+    if isinstance(e, Block):
+        return e.block
+    if isinstance(e, IFExpression):
+        return [e.cond, e.ifTrue, e.ifFalse]
+    if isinstance(e, BinaryOp):
+        return [e.right, e.left]
+    if isinstance(e, UnaryOp):
+        return [e.op, e.val]
+    if isinstance(e, ExpressionList):
+        return e.exprs
+    if isinstance(e, list):
+        return e
+    return []
+
+def walk(e):
+    '''Iterate over an expression and all its sub-expressions'''
+    yield e
+    for c in _children(e):
+        if c is not None:
+            for sub in walk(c):
+                yield sub
+
+_INPUT_FUNCTIONS = ('fastq', 'samfile')
+
+def _file_slots(exprs):
+    '''Find all the file paths mentioned in a script
+
+    Yields triples `(node, holder, key)` such that `holder[key]` is the path
+    (`holder` is either a kwargs dictionary or the `__dict__` of a Literal).
+    Output files are the ones where `node` is a call to `write`.
+    '''
+    def is_path(val):
+        return isinstance(val, str) and '{' not in val
+    for e in walk(exprs):
+        if isinstance(e, FunctionCall):
+            if e.fname in _INPUT_FUNCTIONS and isinstance(e.arg, Literal) and is_path(e.arg.val):
+                yield e, e.arg.__dict__, 'val'
+            elif e.fname == 'write' and is_path(e.kwargs.get('ofile')):
+                yield e, e.kwargs, 'ofile'
+        elif isinstance(e, PairedCalled):
+            for arg in (e.arg1, e.arg2):
+                if isinstance(arg, Literal) and is_path(arg.val):
+                    yield e, arg.__dict__, 'val'
+            if is_path(e.kwargs.get('singles')):
+                yield e, e.kwargs, 'singles'
+
+def _is_output_slot(node):
+    return isinstance(node, FunctionCall) and node.fname == 'write'
+
+def _reads_once(node):
+    '''Whether ngless is known to read the files of input `node` in a single pass
+
+    Unless an explicit `encoding` is given, `fastq`/`paired` open their files
+    twice (first to guess the encoding), so they cannot read from a pipe. For
+    other inputs, this is not guaranteed either.
+    '''
+    if isinstance(node, PairedCalled) or (isinstance(node, FunctionCall) and node.fname == 'fastq'):
+        return node.kwargs.get('encoding') not in (None, '{auto}')
+    return False
+
+
 def _is_pure_ngless_function(fname):
     '''Whether the given ngless function is pure (i.e., does not need to be
     assigned to a variable)'''
     return fname not in ["write"]
 
+def _ngless_cmdline(script_name, ncpus=None, extra_args=[]):
+    cmdline = ['ngless', script_name]
+    if ncpus:
+        cmdline.extend(['-j', str(ncpus)])
+    if extra_args:
+        cmdline.extend(extra_args)
+    return cmdline
+
 class NGLess(object):
-    def __init__(self, version):
+    def __init__(self, version, profile=None):
+        '''
+        Parameters
+        ----------
+        version : str
+            NGLess version
+        profile : bool or ngless.profiling.Profiler, optional
+            Whether to record timings of building and running the script (in
+            `self.profiler`). A `Profiler` object can be shared by several
+            scripts. By default, profiling is enabled if the
+            `NGLESSPY_PROFILE` environment variable is set (see
+            `ngless.profiling`).
+        '''
+        if profile is None:
+            from .profiling import default_profiler
+            profile = default_profiler()
+        elif profile is True:
+            from .profiling import Profiler
+            profile = Profiler()
         self.version = version
         self.modules = []
         self.script = []
         self.nextvarix = 0
+        self.profiler = (profile or None)
         self.env = NGLessEnvironment(self)
 
     def import_(self, modname, modversion):
@@ -293,7 +404,12 @@ class NGLess(object):
         return NGLessVariable(n)
 
     def paired_(self, sample1, sample2, **kwargs):
-        return PairedCalled(sample1, sample2, kwargs, None)
+        if self.profiler is None:
+            return PairedCalled(sample1, sample2, kwargs, None)
+        start = time.time()
+        e = PairedCalled(sample1, sample2, kwargs, None)
+        self.profiler.record('build:paired', 'build', start, time.time())
+        return e
 
 
     def if_(self, cond, ifTrue, ifFalse=None):
@@ -316,7 +432,7 @@ class NGLess(object):
 
 
 
-    def run(self, auto_install=True, verbose=True, ncpus=None, extra_args=[]):
+    def run(self, auto_install=True, verbose=True, ncpus=None, extra_args=[], inprocess=False, history=None, preflight=False, executor=None, preview=None, preview_method='head', decompress=False):
         '''Run the generated script
 
         Parameters
@@ -330,33 +446,181 @@ class NGLess(object):
 
         ncpus : int or str, optional
             How many CPUs to use (corresponds to ngless' -j argument).
-            Can be "auto" or an integer.
+            Can be "auto", "tuned" or an integer. If "tuned", the number is
+            chosen based on previous runs of similar scripts (see
+            `ngless.history`), using "auto" if there are none.
 
         extra_args : list of str, optional
             Extra arguments to pass to ngless
 
+        inprocess : bool, optional (default: False)
+            If true, simple preprocessing scripts (`substrim`/`endstrim` and
+            length based `discard`) are executed directly in Python (this
+            requires numpy). Other scripts fall back to calling ngless.
+
+        history : str or bool, optional
+            Path of the run history database where this run is recorded (by
+            default, `ngless.history.default_path()`). If False, the run is
+            not recorded.
+
+        preflight : bool, optional (default: False)
+            If true, FastQ inputs are checked before calling ngless (see
+            `ngless.preflight`): truncated files and mismatched paired files
+            raise `ngless.preflight.PreflightError`.
+
+        executor : executor object, optional
+            Where to run ngless (see `ngless.executors`). By default, ngless
+            is run as a local subprocess.
+
+        preview : int, optional
+            If given, run only on this number of reads from each input (with
+            all outputs going to a temporary directory) and return a report
+            with estimates for the full run (see `ngless.preview`). Cannot be
+            combined with `decompress`.
+
+        preview_method : str, optional (default: 'head')
+            How to pick reads in preview mode: 'head' (first reads) or
+            'reservoir' (random sample)
+
+        decompress : bool, optional (default: False)
+            If true, large compressed inputs (`.gz` or `.zst`) are decompressed
+            by `pigz`/`zstd` running alongside ngless and passed to it through
+            named pipes (see `ngless.decompress`). Only FastQ inputs with an
+            explicit `encoding` are handled this way (as ngless otherwise
+            reads them twice). Only for local executors.
+
         Returns
         -------
-        None
+        report : dict or None
+            Preview report if `preview` is used (None otherwise)
         '''
-        import tempfile
         import subprocess
+        if preview and decompress:
+            raise ValueError("decompress=True cannot be combined with preview (the preview runs on uncompressed subsamples)")
+        if preflight:
+            from .preflight import check_script
+            check_script(self, verbose=verbose)
+        if preview:
+            from .preview import preview as run_preview
+            return run_preview(self, preview,
+                        method=preview_method,
+                        verbose=verbose,
+                        auto_install=auto_install,
+                        ncpus=ncpus,
+                        extra_args=extra_args,
+                        inprocess=inprocess,
+                        executor=executor)
+        if inprocess:
+            from .inprocess import execute, UnsupportedScript
+            try:
+                execute(self, verbose=verbose)
+                return
+            except UnsupportedScript as e:
+                if verbose:
+                    print("Cannot run script in-process ({}). Calling ngless.".format(e))
+        resources = {}
+        if ncpus == 'tuned':
+            from .history import tuned_resources
+            ncpus, memory = tuned_resources(self, path=(history or None))
+            if memory is not None:
+                resources['memory'] = memory
+            if verbose:
+                print("Using {} CPUs (tuned from run history)".format(ncpus))
+        sc = self
+        decompressor = None
+        if decompress:
+            from .executors import BatchExecutor
+            from .decompress import Decompressor
+            if isinstance(executor, BatchExecutor):
+                raise ValueError("decompress=True cannot be used with a batch executor (the decompressors run locally)")
+            decompressor = Decompressor(self, ncpus=ncpus, verbose=verbose)
+            sc = decompressor.start()
+        returncode = None
+        try:
+            job = sc.submit(executor=executor,
+                        auto_install=auto_install,
+                        verbose=verbose,
+                        ncpus=ncpus,
+                        extra_args=extra_args,
+                        resources=resources)
+            submitted = time.time()
+            try:
+                returncode = job.wait()
+            except BaseException:
+                # As `subprocess.check_call` did, do not leave ngless running
+                # (e.g., on KeyboardInterrupt)
+                job.kill()
+                raise
+        finally:
+            if decompressor is not None:
+                decompressor.finish(check=(returncode == 0))
+        end = time.time()
+        self._profile_job(job, end)
+        if history is not False:
+            # Time spent installing ngless or queued in a scheduler is not
+            # part of the run
+            self._record_history(history, ncpus, end - (job.start_time or submitted), job.peak_rss, returncode == 0, verbose)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, job.cmdline)
+
+    def submit(self, executor=None, auto_install=True, verbose=True, ncpus=None, extra_args=[], resources=None):
+        '''Start running the generated script without waiting for it
+
+        See `run` for the meaning of the arguments (`ncpus` must be an
+        integer or "auto"). `resources` is a dictionary of hints for batch
+        schedulers (see `ngless.executors.BatchExecutor`).
+
+        Returns
+        -------
+        job : ngless.executors.Job
+            Call `job.wait()` to wait for the job to finish
+        '''
+        from . import executors
         if auto_install:
             from . import install
+            start = time.time()
             install.install_ngless(verbose=verbose)
-        with tempfile.NamedTemporaryFile('w+', suffix='.ngl', delete=False) as tfile:
-            try:
-                tfile.write(self.generate())
-                print(self.generate())
-                tfile.close()
-                cmdline = ['ngless', tfile.name]
-                if ncpus:
-                    cmdline.extend(['-j', str(ncpus)])
-                if extra_args:
-                    cmdline.extend(extra_args)
-                subprocess.check_call(cmdline)
-            finally:
-                os.unlink(tfile.name)
+            if self.profiler is not None:
+                self.profiler.record('install_ngless', 'launch', start, time.time())
+        if executor is None:
+            executor = executors.LocalExecutor()
+        script = self.generate()
+        if verbose:
+            print(script)
+        return executor.submit(script, ncpus=ncpus, extra_args=extra_args, resources=resources)
+
+    def validate(self, auto_install=True, verbose=False, extra_args=[]):
+        '''Check the generated script with `ngless --validate-only`
+
+        See `ngless.validate` (use `validate.validate_many` for many scripts).
+
+        Returns
+        -------
+        errors : list of dict
+            Errors found (empty if the script is valid). Each error includes
+            the Python call site which created the offending expression.
+        '''
+        from .validate import validate_many
+        return validate_many([self], auto_install=auto_install, verbose=verbose, extra_args=extra_args)[0]
+
+    def _profile_job(self, job, end):
+        '''Record the launch and execution phases of a job which finished at `end`'''
+        if self.profiler is None:
+            return
+        for phase, (start, stop) in getattr(job, 'timings', {}).items():
+            self.profiler.record(phase, 'launch', start, stop)
+        if job.start_time is not None:
+            self.profiler.record('execute', 'run', job.start_time, end, returncode=job.returncode, peak_rss=job.peak_rss)
+
+    def _record_history(self, path, ncpus, wall_time, peak_rss, success, verbose):
+        import sqlite3
+        from .history import RunHistory
+        try:
+            RunHistory(path or None).record(self, ncpus, wall_time, peak_rss, success)
+        except (sqlite3.Error, OSError) as e:
+            # Failing to record the history should never fail the run
+            if verbose:
+                print("Could not record run in history: {}".format(e))
 
     def generate(self):
         '''Generate and return NGLess script'''
@@ -366,17 +630,55 @@ class NGLess(object):
         for (modname,modversion) in self.modules:
             out.write('import "{}" version "{}"\n'.format(modname, modversion))
         out.write("\n")
+        profiler = self.profiler
         for e in self.script:
+            if profiler is not None:
+                start = time.time()
             out.write(e.generate())
             out.write('\n')
+            if profiler is not None:
+                profiler.record('generate:' + type(e).__name__, 'generate', start, time.time())
         return out.getvalue()
 
     def assign(self, var, expr):
         self.add_expression(Assignment(var, expr))
 
+    def input_files(self):
+        '''Return the list of input files (arguments to fastq/paired/samfile)'''
+        return [h[k] for n, h, k in _file_slots(self.script) if not _is_output_slot(n)]
+
+    def output_files(self):
+        '''Return the list of files written by the script'''
+        return [h[k] for n, h, k in _file_slots(self.script) if _is_output_slot(n)]
+
+    def with_paths(self, mapping):
+        '''Return a copy of this script with file paths replaced
+
+        Parameters
+        ----------
+        mapping : dict
+            Maps original paths (as they appear in the script) to new paths.
+            Paths not in `mapping` are kept.
+
+        Returns
+        -------
+        sc : NGLess
+        '''
+        import copy
+        sc = copy.deepcopy(self)
+        for _, holder, key in _file_slots(sc.script):
+            holder[key] = mapping.get(holder[key], holder[key])
+        return sc
+
     def __getattr__(self, name):
-        if name.endswith('_'):
-            return self.function(name[:-1])
+        if name.endswith('_') and not name.startswith('__'):
+            profiler = self.__dict__.get('profiler')
+            if profiler is None:
+                return self.function(name[:-1])
+            start = time.time()
+            f = self.function(name[:-1])
+            profiler.record('getattr:' + name, 'build', start, time.time())
+            return f
         raise AttributeError('Unknown attribute')
 
     def function(self, fname):
@@ -385,8 +687,12 @@ class NGLess(object):
         return make_call
 
     def function_call(self, fname, arg, **kwargs):
+        if self.profiler is not None:
+            start = time.time()
         e = FunctionCall(fname, arg, kwargs, None)
         if not _is_pure_ngless_function(fname):
             self.add_expression(e)
+        if self.profiler is not None:
+            self.profiler.record('build:' + fname, 'build', start, time.time())
         return e
 
@@ -0,0 +1,197 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+'''
+Running many scripts
+
+Example
+-------
+
+    from ngless import batch, executors
+
+    scripts = [build_script(sample) for sample in samples]
+    ex = executors.BatchExecutor(executors.SlurmScheduler(), workdir='/shared/jobs')
+    batch.run_many(scripts, executor=ex, ncpus=8, speculate=True)
+
+## Speculative execution
+
+With `speculate=True`, stragglers are re-executed. As ngless does not report
+its progress, the progress rate of a job is measured as its input size
+divided by its running time. Once enough jobs have finished, a job which has
+been running for longer than `slow_factor` times what the median rate of the
+finished jobs predicts gets a duplicate, which writes its outputs to an
+isolated directory. Whichever copy finishes first is kept and the other one
+is killed.
+'''
+
+import os
+import shutil
+import tempfile
+import time
+
+class BatchError(Exception):
+    '''Some of the scripts in a batch failed
+
+    Attributes
+    ----------
+    failed : list of (int, int)
+        Index of the script and its exit code for every failure
+    '''
+    def __init__(self, failed):
+        Exception.__init__(self, "{} job(s) failed (index, exit code): {}".format(len(failed), failed))
+        self.failed = failed
+
+
+class _Attempt(object):
+    def __init__(self, job, submitted, outdir=None, outputs=None):
+        self.job = job
+        self.submitted = submitted
+        self.outdir = outdir
+        self.outputs = outputs or {}
+
+    def elapsed(self, now):
+        return now - (self.job.start_time or self.submitted)
+
+    def cleanup(self):
+        if self.outdir is not None:
+            shutil.rmtree(self.outdir, ignore_errors=True)
+
+
+def run_many(scripts, executor=None, auto_install=True, verbose=True, ncpus=None, extra_args=[], resources=None, history=None,
+                speculate=False, slow_factor=2., min_finished=None, workdir=None, validate=False):
+    '''Submit all scripts and wait for all of them to finish
+
+    Parameters
+    ----------
+    scripts : list of NGLess
+    executor : executor object, optional
+        See `ngless.executors` (default: run all scripts at once on the local
+        machine)
+    resources : dict or list of dict, optional
+        Resource hints for the scheduler (one for all scripts or one per script)
+    history : str or bool, optional
+        See `NGLess.run`
+    speculate : bool, optional (default: False)
+        Whether to launch duplicates of straggling jobs
+    slow_factor : float, optional (default: 2)
+        How much slower than expected a job must be to be duplicated
+    min_finished : int, optional
+        How many jobs must have finished before speculating (default: a
+        quarter of the jobs)
+    workdir : str, optional
+        Where duplicates write their outputs before they are moved into place
+        (default: the system temporary directory). With a batch scheduler,
+        this must be visible from the compute nodes.
+    validate : bool, optional (default: False)
+        Whether to validate all scripts (in parallel) before submitting any
+        (see `ngless.validate`)
+
+    Other arguments are as in `NGLess.run`.
+
+    Raises
+    ------
+    BatchError
+        If any script fails (after waiting for all of them)
+    ngless.validate.ValidationError
+        If `validate` is true and any script is invalid (nothing is run)
+    '''
+    from .history import input_size
+    scripts = list(scripts)
+    if not isinstance(resources, list):
+        resources = [resources for _ in scripts]
+    script_ncpus = [ncpus for _ in scripts]
+    if ncpus == 'tuned':
+        # As in `NGLess.run`, but resolved separately for each script
+        from .history import tuned_resources
+        resources = [dict(r or {}) for r in resources]
+        for ix, sc in enumerate(scripts):
+            script_ncpus[ix], memory = tuned_resources(sc, path=(history or None))
+            if memory is not None:
+                resources[ix]['memory'] = memory
+    if min_finished is None:
+        min_finished = max(1, len(scripts) // 4)
+    if auto_install:
+        from . import install
+        install.install_ngless(verbose=verbose)
+    if validate:
+        from .validate import validate_many, ValidationError
+        errors = validate_many(scripts, auto_install=False, verbose=verbose, extra_args=extra_args)
+        invalid = [(ix, errs) for ix, errs in enumerate(errors) if errs]
+        if invalid:
+            raise ValidationError(invalid)
+
+    def submit(ix, sc):
+        return sc.submit(executor=executor,
+                    auto_install=False,
+                    verbose=verbose,
+                    ncpus=script_ncpus[ix],
+                    extra_args=extra_args,
+                    resources=resources[ix])
+
+    attempts = []
+    try:
+        for ix, sc in enumerate(scripts):
+            attempts.append([_Attempt(submit(ix, sc), time.time())])
+        sizes = [max(1, input_size(sc)) if speculate else 1 for sc in scripts]
+        rates = []
+        failed = []
+        running = list(range(len(scripts)))
+        while running:
+            for ix in list(running):
+                for att in list(attempts[ix]):
+                    returncode = att.job.poll()
+                    if returncode is None:
+                        continue
+                    now = time.time()
+                    if returncode != 0 and len(attempts[ix]) > 1:
+                        # Another copy is still running
+                        attempts[ix].remove(att)
+                        att.cleanup()
+                        continue
+                    running.remove(ix)
+                    for other in attempts[ix]:
+                        if other is not att:
+                            other.job.kill()
+                            other.cleanup()
+                    if returncode == 0:
+                        for final, tmp in att.outputs.items():
+                            shutil.move(tmp, final)
+                        rates.append(sizes[ix] / max(att.elapsed(now), 1e-3))
+                        if verbose and att.outdir is not None:
+                            print("Speculative copy of job {} finished first".format(ix))
+                    att.cleanup()
+                    scripts[ix]._profile_job(att.job, now)
+                    if history is not False:
+                        scripts[ix]._record_history(history, script_ncpus[ix], att.elapsed(now), att.job.peak_rss, returncode == 0, verbose)
+                    if returncode != 0:
+                        failed.append((ix, returncode))
+                    break
+
+            if speculate and len(rates) >= min_finished:
+                now = time.time()
+                median = sorted(rates)[len(rates) // 2]
+                for ix in running:
+                    if len(attempts[ix]) != 1 or attempts[ix][0].job.start_time is None:
+                        continue
+                    if attempts[ix][0].elapsed(now) > slow_factor * sizes[ix] / median:
+                        outdir = tempfile.mkdtemp(prefix='nglesspy-speculative-', dir=workdir)
+                        outputs = {}
+                        for ox, f in enumerate(set(scripts[ix].output_files())):
+                            outputs[f] = os.path.join(outdir, str(ox), os.path.basename(f))
+                            os.mkdir(os.path.dirname(outputs[f]))
+                        if verbose:
+                            print("Job {} is straggling: launching a speculative copy".format(ix))
+                        dup = scripts[ix].with_paths(outputs)
+                        attempts[ix].append(_Attempt(submit(ix, dup), now, outdir,
+                                dict((os.path.abspath(f), t) for f, t in outputs.items())))
+            if running:
+                time.sleep(attempts[running[0]][0].job.poll_interval)
+    except BaseException:
+        # As in `NGLess.run`, do not leave jobs running (e.g., on
+        # KeyboardInterrupt or if a job cannot be started)
+        for atts in attempts:
+            for att in atts:
+                att.job.kill()
+                att.cleanup()
+        raise
+    if failed:
+        raise BatchError(sorted(failed))
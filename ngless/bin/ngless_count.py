@@ -11,7 +11,7 @@ except ImportError:
     sys.exit(1)
 
 
-def parse_args():
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", required=True,
                         help="SAM/BAM/CRAM file to count reads on")
@@ -21,13 +21,19 @@ def parse_args():
                         help="Feature to count")
     parser.add_argument("-m", "--multiple",
                         choices=["dist1", "all1", "1overN", "unique_only"],
-                        help="How to handle multiple mappers")
+                        help="How to handle reads that map to more than one location?")
     parser.add_argument("--auto-install", action="store_true",
                         help="Install NGLess if not found in PATH")
     parser.add_argument("--debug", action="store_true",
                         help="Prints the payload before submitting to ngless")
+    parser.add_argument("-j", "--threads", type=int, default=1,
+                        help="Number of threads to use")
+
+    return parser
 
-    return parser.parse_args()
+
+def parse_args():
+    return build_parser().parse_args()
 
 
 def ngless_count(args):
@@ -48,7 +54,7 @@ def ngless_count(args):
     sc.write_(e.counts,
                 ofile=args.output)
 
-    sc.run(verbose=args.debug, auto_install=args.auto_install)
+    sc.run(verbose=args.debug, auto_install=args.auto_install, ncpus=args.threads)
 
 def main():
     args = parse_args()
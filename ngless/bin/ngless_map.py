@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import sys
-from ngless import NGLess
+from ngless import NGLess, sharded
+from ngless.preview import format_report
 
 try:
     import argparse
@@ -11,7 +12,7 @@ except ImportError:
     sys.exit(1)
 
 
-def parse_args():
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", required=True,
                         help="FastQ file with reads to map (forward)")
@@ -25,20 +26,58 @@ def parse_args():
                         help="Install NGLess if not found in PATH")
     parser.add_argument("--debug", action="store_true",
                         help="Prints the payload before submitting to ngless")
+    parser.add_argument("-j", "--threads", type=int, default=1,
+                        help="Number of threads to use")
+    parser.add_argument("--preview", type=int, metavar="N",
+                        help="Only process the first N reads and report estimates for the full input (outputs are not kept)")
+    parser.add_argument("--preflight", action="store_true",
+                        help="Check that input files are complete (and that paired files match) before mapping")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Split the --fasta reference into this many pieces, map against them in parallel and merge the results")
+    parser.add_argument("--max-jobs", type=int,
+                        help="With --shards, maximum number of shards mapped at the same time (by default, all of them, which needs memory for the whole index)")
+    parser.add_argument("--shard-dir",
+                        help="With --shards, directory where the shards and their indices are kept (default: <fasta>.shards<N>)")
+    parser.add_argument("--encoding", choices=["auto", "33", "64", "sanger", "solexa"], default="auto",
+                        help="Quality encoding of the input ('auto' guesses it, which requires reading the input twice)")
+    parser.add_argument("--decompress", action="store_true",
+                        help="Decompress large .gz/.zst inputs with pigz/zstd in parallel to ngless (needs --threads > 1 and an explicit --encoding)")
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("-r", "--reference",
                        choices=["sacCer3", "ce10", "dm3", "gg4", "canFam2",
                                 "rn4", "bosTau4", "mm10", "hg19"],
-                       help="Map against a builtin reference")
+                       help="Select one of the reference databases included with ngless")
     group.add_argument("-f", "--fasta",
                        help="Map against a given fasta file (will be indexed if index is not available)")
 
+    return parser
+
+
+def parse_args():
+    parser = build_parser()
     args = parser.parse_args()
 
     if args.input_singles and not args.input_reverse:
         parser.error("--input-singles cannot be used without --input-reverse, use --input instead")
 
+    if args.shards > 1 and not args.fasta:
+        parser.error("--shards can only be used with --fasta")
+    if args.shards > 1 and args.preview:
+        parser.error("--shards cannot be combined with --preview")
+    if args.shards > 1 and args.decompress:
+        parser.error("--shards cannot be combined with --decompress")
+    if args.shards > 1 and args.encoding != "auto":
+        parser.error("--shards cannot be combined with --encoding")
+    if args.shards <= 1 and (args.max_jobs or args.shard_dir):
+        parser.error("--max-jobs and --shard-dir can only be used with --shards")
+    if args.preview and args.decompress:
+        parser.error("--preview cannot be combined with --decompress")
+    if args.decompress and args.threads < 2:
+        parser.error("--decompress needs --threads > 1 (the decompressor runs alongside ngless)")
+    if args.decompress and args.encoding == "auto":
+        parser.error("--decompress needs an explicit --encoding (to guess it, ngless reads the input twice)")
+
     if args.input_reverse:
         args.target = "paired"
     else:
@@ -47,16 +86,44 @@ def parse_args():
     return args
 
 
+def fastq_args(args):
+    if args.encoding == "auto":
+        return {}
+    return {'encoding': '{' + args.encoding + '}'}
+
+
+def ngless_map_sharded(args):
+    if args.preflight:
+        from ngless.preflight import check_paired, inspect_fastq
+        if args.input_reverse:
+            check_paired(args.input, args.input_reverse, args.input_singles)
+        else:
+            inspect_fastq(args.input)
+    executor = None
+    if args.max_jobs:
+        from ngless.executors import PoolExecutor
+        executor = PoolExecutor(args.max_jobs)
+    sharded.map_sharded(args.input, args.fasta, args.output, args.shards,
+                input_reverse=args.input_reverse,
+                input_singles=args.input_singles,
+                executor=executor,
+                shard_dir=args.shard_dir,
+                ncpus=args.threads,
+                auto_install=args.auto_install,
+                verbose=args.debug)
+
 def ngless_map(args):
+    if args.shards > 1:
+        return ngless_map_sharded(args)
     sc = NGLess.NGLess('0.8')
     e = sc.env
     if args.input_reverse:
-        paired_args = {}
+        paired_args = fastq_args(args)
         if args.input_singles:
             paired_args['singles'] = args.input_singles
         e.input = sc.paired_(args.input, args.input_reverse, **paired_args)
     else:
-        e.input = sc.fastq_(args.input)
+        e.input = sc.fastq_(args.input, **fastq_args(args))
     if args.reference:
         map_opts = {'reference': args.reference}
     elif args.fasta:
@@ -67,7 +134,9 @@ def ngless_map(args):
     sc.write_(e.mapped,
                 ofile=args.output)
 
-    sc.run(verbose=args.debug, auto_install=args.auto_install)
+    report = sc.run(verbose=args.debug, auto_install=args.auto_install, ncpus=args.threads, preflight=args.preflight, preview=args.preview, decompress=args.decompress)
+    if report is not None:
+        print(format_report(report))
 
 def main():
     ngless_map(parse_args())
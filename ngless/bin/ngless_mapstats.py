@@ -10,7 +10,7 @@ except ImportError:
     sys.exit(1)
 
 
-def parse_args():
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", required=True,
                         help="SAM/BAM/CRAM file filter")
@@ -20,8 +20,14 @@ def parse_args():
                         help="Install NGLess if not found in PATH")
     parser.add_argument("--debug", action="store_true",
                         help="Prints the payload before submitting to ngless")
+    parser.add_argument("-j", "--threads", type=int, default=1,
+                        help="Number of threads to use")
+
+    return parser
 
-    return parser.parse_args()
+
+def parse_args():
+    return build_parser().parse_args()
 
 
 def ngless_mapstats(args):
@@ -32,7 +38,7 @@ def ngless_mapstats(args):
     sc.write_(e.stats,
                 ofile=args.output)
 
-    sc.run(verbose=args.debug, auto_install=args.auto_install)
+    sc.run(verbose=args.debug, auto_install=args.auto_install, ncpus=args.threads)
 
 
 def main():
@@ -11,7 +11,7 @@ except ImportError:
     sys.exit(1)
 
 
-def parse_args():
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", required=True,
                         help="SAM/BAM/CRAM file filter")
@@ -19,16 +19,22 @@ def parse_args():
                         help="Output file/path for results")
     parser.add_argument("-a", "--action", required=True,
                         choices=["keep_if", "drop_if"],
-                        help="Whether to keep or drop when condition are met")
+                        help="When selecting reads, target reads are either kept or dropped (see also --conditions)")
     parser.add_argument("-c", "--conditions", required=True, nargs="+",
                         choices=["mapped", "unmapped", "unique"],
-                        help="One or more conditions to filter on")
+                        help="When keeping/dropping reads select which subset should be targetted")
     parser.add_argument("--auto-install", action="store_true",
                         help="Install NGLess if not found in PATH")
     parser.add_argument("--debug", action="store_true",
                         help="Prints the payload before submitting to ngless")
+    parser.add_argument("-j", "--threads", type=int, default=1,
+                        help="Number of threads to use")
+
+    return parser
 
-    return parser.parse_args()
+
+def parse_args():
+    return build_parser().parse_args()
 
 
 def ngless_select(args):
@@ -42,7 +48,7 @@ def ngless_select(args):
     e.selected = sc.select_(e.samfile, **select_opts)
     sc.write_(e.selected,
                 ofile=args.output)
-    sc.run(verbose=args.debug, auto_install=args.auto_install)
+    sc.run(verbose=args.debug, auto_install=args.auto_install, ncpus=args.threads)
 
 def main():
     args = parse_args()
@@ -3,6 +3,7 @@
 
 import sys
 from ngless import NGLess
+from ngless.preview import format_report
 
 try:
     import argparse
@@ -11,7 +12,7 @@ except ImportError:
     sys.exit(1)
 
 
-def parse_args():
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", required=True,
                         help="FastQ file with reads to trim")
@@ -19,7 +20,7 @@ def parse_args():
                         help="Output file/path for results")
     parser.add_argument("-m", "--method", required=True,
                         choices=["substrim", "endstrim"],
-                        help="Which trimming method to use")
+                        help="Given a read, keep the longest segment above a quality threshold (substrim) or trim from both ends (endstrim)")
     parser.add_argument("-q", "--min-quality", type=int, required=True,
                         help="Minimum quality value")
     parser.add_argument("-d", "--discard", type=int, default=50,
@@ -28,14 +29,42 @@ def parse_args():
                         help="Install NGLess if not found in PATH")
     parser.add_argument("--debug", action="store_true",
                         help="Prints the payload before submitting to ngless")
+    parser.add_argument("-j", "--threads", type=int, default=1,
+                        help="Number of threads to use")
+    parser.add_argument("--preview", type=int, metavar="N",
+                        help="Only process the first N reads and report estimates for the full input (outputs are not kept)")
+    parser.add_argument("--in-process", action="store_true",
+                        help="Trim in Python instead of calling ngless (faster for small files, requires numpy)")
+    parser.add_argument("--encoding", choices=["auto", "33", "64", "sanger", "solexa"], default="auto",
+                        help="Quality encoding of the input ('auto' guesses it, which requires reading the input twice)")
+    parser.add_argument("--decompress", action="store_true",
+                        help="Decompress large .gz/.zst inputs with pigz/zstd in parallel to ngless (needs --threads > 1 and an explicit --encoding)")
+
+    return parser
+
+
+def parse_args():
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.preview and args.decompress:
+        parser.error("--preview cannot be combined with --decompress")
+    if args.decompress and args.threads < 2:
+        parser.error("--decompress needs --threads > 1 (the decompressor runs alongside ngless)")
+    if args.decompress and args.encoding == "auto":
+        parser.error("--decompress needs an explicit --encoding (to guess it, ngless reads the input twice)")
+    return args
+
 
-    return parser.parse_args()
+def fastq_args(args):
+    if args.encoding == "auto":
+        return {}
+    return {'encoding': '{' + args.encoding + '}'}
 
 
 def ngless_trim(args):
     sc = NGLess.NGLess('0.8')
     e = sc.env
-    e.input = sc.fastq_(args.input)
+    e.input = sc.fastq_(args.input, **fastq_args(args))
 
     @sc.preprocess_(e.input, using='r')
     def proc(bk):
@@ -46,7 +75,9 @@ def ngless_trim(args):
     sc.write_(e.input,
                 ofile=args.output)
 
-    sc.run(verbose=args.debug, auto_install=args.auto_install)
+    report = sc.run(verbose=args.debug, auto_install=args.auto_install, ncpus=args.threads, inprocess=args.in_process, preview=args.preview, decompress=args.decompress)
+    if report is not None:
+        print(format_report(report))
 
 def main():
     args = parse_args()
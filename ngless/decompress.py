@@ -0,0 +1,171 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+'''
+Decompression of inputs in separate processes
+
+Compressed `fastq`/`paired` inputs (`.gz` or `.zst`) can be decompressed by
+an external tool (`pigz` or `zstd`) which writes into a named pipe (FIFO)
+that ngless reads instead of the original file. Decompression then runs
+concurrently with (and does not take CPU time from) the rest of the
+processing.
+
+Note that neither format can be decompressed in independent blocks, so each
+file still uses a single decompression thread; `pigz` uses its extra threads
+for reading, writing and checksumming.
+
+A FIFO can only be read once, but ngless guesses the encoding of FastQ files
+by reading their start before processing them. Therefore, only inputs with an
+explicit encoding (e.g., `sc.fastq_('sample.fq.zst', encoding='{33}')`) are
+decompressed separately. Inputs are also read natively by ngless (i.e.,
+nothing is changed) when the tool is not installed, when the file is small,
+when ngless uses a single CPU, or when the same file is used more than once.
+
+Example
+-------
+
+    e.input = sc.fastq_('sample.fq.gz', encoding='{33}')
+    ...
+    sc.run(ncpus=32, decompress=True)
+'''
+
+import os
+import shlex
+import shutil
+import signal
+import subprocess
+import tempfile
+
+from . import NGLess as ngl
+from .history import _effective_ncpus
+
+# Extension -> (tool, arguments); {threads} is replaced by the number of threads
+DECOMPRESSORS = {
+    '.gz': ('pigz', ['-dc', '-p', '{threads}']),
+    '.zst': ('zstd', ['-dc', '-q', '-T{threads}']),
+}
+
+# Files smaller than this (in bytes) are left to ngless
+MIN_SIZE = 64 * 2**20
+
+# Maximum number of threads given to each decompressor
+MAX_THREADS = 4
+
+def decompressor_for(fname, threads=1):
+    '''Command line to decompress `fname` to stdout (None if no tool is available)'''
+    ext = os.path.splitext(fname)[1]
+    if ext not in DECOMPRESSORS:
+        return None
+    tool, args = DECOMPRESSORS[ext]
+    if shutil.which(tool) is None:
+        return None
+    return [tool] + [a.format(threads=threads) for a in args] + [fname]
+
+
+class Decompressor(object):
+    '''Decompress the inputs of a script into FIFOs
+
+    Parameters
+    ----------
+    sc : NGLess
+    ncpus : int or str, optional
+        Number of CPUs given to ngless
+    min_size : int, optional
+        Smaller files are read directly by ngless (default: `MIN_SIZE`)
+    verbose : bool, optional
+    '''
+    def __init__(self, sc, ncpus=None, min_size=None, verbose=True):
+        self.sc = sc
+        self.ncpus = _effective_ncpus(ncpus)
+        self.min_size = (MIN_SIZE if min_size is None else min_size)
+        self.verbose = verbose
+        self.tdir = None
+        self.procs = []
+
+    def _candidates(self):
+        if self.ncpus < 2:
+            if self.verbose:
+                print("Not decompressing inputs separately (ngless uses a single CPU)")
+            return []
+        slots = [(node, holder[key]) for node, holder, key in ngl._file_slots(self.sc.script)
+                        if not ngl._is_output_slot(node)]
+        inputs = [f for _, f in slots]
+        selected = []
+        for node, f in slots:
+            if os.path.splitext(f)[1] not in DECOMPRESSORS:
+                continue
+            reason = None
+            if inputs.count(f) > 1:
+                reason = 'it is used more than once'
+            elif not ngl._reads_once(node):
+                reason = 'ngless reads it twice to guess its encoding; pass an explicit encoding'
+            elif not os.path.exists(f) or os.path.getsize(f) < self.min_size:
+                reason = 'it is small (or missing)'
+            elif decompressor_for(f) is None:
+                reason = "'{}' is not installed".format(DECOMPRESSORS[os.path.splitext(f)[1]][0])
+            if reason is not None:
+                if self.verbose:
+                    print("Letting ngless decompress '{}' ({})".format(f, reason))
+                continue
+            selected.append(f)
+        return selected
+
+    def start(self):
+        '''Start the decompressors
+
+        Returns
+        -------
+        sc : NGLess
+            The script to run (reading from the FIFOs)
+        '''
+        inputs = self._candidates()
+        if not inputs:
+            return self.sc
+        threads = max(1, min(MAX_THREADS, self.ncpus // len(inputs)))
+        self.tdir = tempfile.mkdtemp(prefix='nglesspy-decompress-')
+        mapping = {}
+        for ix, f in enumerate(inputs):
+            fifo = os.path.join(self.tdir, 'in{}'.format(ix), os.path.splitext(os.path.basename(f))[0])
+            os.mkdir(os.path.dirname(fifo))
+            os.mkfifo(fifo)
+            mapping[f] = fifo
+            cmdline = decompressor_for(f, threads)
+            if self.verbose:
+                print("Decompressing '{}' with {}".format(f, cmdline[0]))
+            # The shell blocks opening the FIFO until ngless opens it for reading
+            self.procs.append(subprocess.Popen(['/bin/sh', '-c',
+                    'exec {} > {}'.format(' '.join(shlex.quote(c) for c in cmdline), shlex.quote(fifo))]))
+        return self.sc.with_paths(mapping)
+
+    def finish(self, check=True):
+        '''Stop all decompressors and remove the FIFOs
+
+        Parameters
+        ----------
+        check : bool, optional (default: True)
+            Whether to check that the decompressors succeeded (set it to
+            False if ngless failed). Decompressors which are still running
+            are killed, which is not considered a failure.
+
+        Raises
+        ------
+        subprocess.CalledProcessError
+            If a decompressor failed (and `check` is true)
+        '''
+        failed = None
+        for p in self.procs:
+            try:
+                # After ngless has finished, the decompressors are either
+                # done or about to be killed by SIGPIPE
+                p.wait(timeout=(5 if check else 0))
+            except subprocess.TimeoutExpired:
+                p.kill()
+                p.wait()
+                continue
+            if p.returncode not in (0, -signal.SIGPIPE) and failed is None:
+                failed = p
+        self.procs = []
+        if self.tdir is not None:
+            shutil.rmtree(self.tdir, ignore_errors=True)
+            self.tdir = None
+        if check and failed is not None:
+            raise subprocess.CalledProcessError(failed.returncode, failed.args)
@@ -0,0 +1,436 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+'''
+Executor backends
+
+An executor takes a generated NGLess script and runs it somewhere, returning a
+`Job` handle. All jobs support `poll()`, `wait()` and `kill()`.
+
+- `LocalExecutor` (the default) runs ngless as a local subprocess
+- `PoolExecutor` runs at most `max_jobs` scripts at a time on the local machine
+- `BatchExecutor` submits scripts to a batch scheduler (`SlurmScheduler`) and
+  polls for completion. `LocalQueue` is a stand-in scheduler which runs jobs on
+  the local machine, which is useful for testing without a cluster.
+
+Schedulers implement `submit(job_script, resources)` (returning a job id),
+`status(job_id)` (exit code or None if not finished), `start_time(job_id)`
+(None while the job is pending) and `cancel(job_id)`.
+
+Example
+-------
+
+    from ngless import executors
+
+    ex = executors.BatchExecutor(executors.SlurmScheduler(), workdir='/shared/jobs')
+    sc.run(executor=ex, ncpus=8)
+'''
+
+import os
+import sys
+import shlex
+import subprocess
+import tempfile
+import time
+import threading
+
+from .NGLess import _ngless_cmdline
+
+def _write_script(script, workdir=None, suffix='.ngl'):
+    fd, name = tempfile.mkstemp(suffix=suffix, prefix='nglesspy-', dir=workdir)
+    with os.fdopen(fd, 'w') as output:
+        output.write(script)
+    return name
+
+def _unlink_all(*names):
+    for name in names:
+        if os.path.exists(name):
+            os.unlink(name)
+
+def _decode_status(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class Job(object):
+    '''Handle for a submitted script
+
+    Attributes
+    ----------
+    cmdline : list of str
+        The ngless command line
+    returncode : int or None
+        Exit code (None while the job is not finished)
+    peak_rss : int or None
+        Peak memory usage in bytes (if known)
+    start_time : float or None
+        When the job started running (None while it is queued)
+    timings : dict
+        Start and end times of the steps taken to launch the job (e.g.,
+        `write_script` and `spawn`)
+    '''
+    poll_interval = .1
+
+    def __init__(self, cmdline, script_name):
+        self.cmdline = cmdline
+        self.script_name = script_name
+        self.returncode = None
+        self.peak_rss = None
+        self.start_time = None
+        self.timings = {}
+
+    def _check(self):
+        '''Return the exit code if the job has finished (None otherwise)'''
+        raise NotImplementedError("No _check function")
+
+    def poll(self):
+        '''Check whether the job has finished; returns the exit code or None'''
+        if self.returncode is None:
+            returncode = self._check()
+            if returncode is not None:
+                self.returncode = returncode
+                self._cleanup()
+        return self.returncode
+
+    def wait(self):
+        '''Wait for the job to finish and return its exit code'''
+        while self.poll() is None:
+            time.sleep(self.poll_interval)
+        return self.returncode
+
+    def kill(self):
+        '''Terminate the job'''
+        raise NotImplementedError("No kill function")
+
+    def _cleanup(self):
+        if self.script_name is not None and os.path.exists(self.script_name):
+            os.unlink(self.script_name)
+
+
+class LocalJob(Job):
+    '''Job running as a local subprocess'''
+    def __init__(self, cmdline, script_name):
+        Job.__init__(self, cmdline, script_name)
+        spawn = time.time()
+        self.process = subprocess.Popen(cmdline)
+        self.start_time = time.time()
+        self.timings['spawn'] = (spawn, self.start_time)
+
+    def _check(self):
+        if not hasattr(os, 'wait4'):
+            return self.process.poll()
+        pid, status, usage = os.wait4(self.process.pid, os.WNOHANG)
+        if pid == 0:
+            return None
+        # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+        self.peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        self.process.returncode = _decode_status(status)
+        return self.process.returncode
+
+    def wait(self):
+        if self.returncode is None and hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(self.process.pid, 0)
+            self.peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+            self.process.returncode = self.returncode = _decode_status(status)
+            self._cleanup()
+        return Job.wait(self)
+
+    def kill(self):
+        if self.poll() is None:
+            self.process.kill()
+            self.wait()
+
+
+class LocalExecutor(object):
+    '''Run each script as a local subprocess'''
+    def submit(self, script, ncpus=None, extra_args=[], resources=None):
+        '''Start running `script` (text of an NGLess script)
+
+        Returns
+        -------
+        job : Job
+        '''
+        start = time.time()
+        script_name = _write_script(script)
+        written = time.time()
+        try:
+            job = LocalJob(_ngless_cmdline(script_name, ncpus, extra_args), script_name)
+        except:
+            _unlink_all(script_name)
+            raise
+        job.timings['write_script'] = (start, written)
+        return job
+
+
+class PoolJob(Job):
+    '''Job waiting for (or running in) a slot of a `PoolExecutor`'''
+    def __init__(self, cmdline, script_name, slots):
+        Job.__init__(self, cmdline, script_name)
+        self.job = None
+        self.error = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.slots = slots
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        # Jobs cancelled while waiting for a slot stop waiting
+        while not self.slots.acquire(timeout=self.poll_interval):
+            if self.cancelled:
+                return
+        try:
+            with self.lock:
+                if self.cancelled:
+                    return
+                try:
+                    self.job = LocalJob(self.cmdline, None)
+                except Exception as e:
+                    # Re-raised by `poll`/`wait`
+                    self.error = e
+                    return
+                self.start_time = self.job.start_time
+                self.timings.update(self.job.timings)
+            self.job.wait()
+        finally:
+            self.slots.release()
+
+    def _check(self):
+        if self.thread.is_alive():
+            return None
+        if self.error is not None:
+            self._cleanup()
+            raise self.error
+        if self.job is None:
+            return -9
+        self.peak_rss = self.job.peak_rss
+        return self.job.returncode
+
+    def kill(self):
+        with self.lock:
+            self.cancelled = True
+            if self.job is not None and self.job.returncode is None:
+                # The pool thread is waiting on the process and will reap it
+                self.job.process.kill()
+        self.thread.join()
+        if self.error is not None:
+            # It never started
+            self._cleanup()
+            return
+        self.wait()
+
+
+class PoolExecutor(object):
+    '''Run scripts locally, at most `max_jobs` at the same time
+
+    Parameters
+    ----------
+    max_jobs : int, optional
+        Maximum number of concurrent jobs (default: number of CPUs)
+    '''
+    def __init__(self, max_jobs=None):
+        self.slots = threading.Semaphore(max_jobs or os.cpu_count() or 1)
+
+    def submit(self, script, ncpus=None, extra_args=[], resources=None):
+        start = time.time()
+        script_name = _write_script(script)
+        try:
+            job = PoolJob(_ngless_cmdline(script_name, ncpus, extra_args), script_name, self.slots)
+        except:
+            _unlink_all(script_name)
+            raise
+        job.timings['write_script'] = (start, time.time())
+        return job
+
+
+class BatchJob(Job):
+    '''Job submitted to a batch scheduler'''
+    def __init__(self, cmdline, script_name, job_script, scheduler, job_id, poll_interval):
+        Job.__init__(self, cmdline, script_name)
+        self.job_script = job_script
+        self.scheduler = scheduler
+        self.job_id = job_id
+        self.poll_interval = poll_interval
+
+    def _check(self):
+        returncode = self.scheduler.status(self.job_id)
+        if self.start_time is None:
+            self.start_time = self.scheduler.start_time(self.job_id)
+        return returncode
+
+    def kill(self):
+        if self.poll() is None:
+            self.scheduler.cancel(self.job_id)
+            self.wait()
+
+    def _cleanup(self):
+        Job._cleanup(self)
+        if os.path.exists(self.job_script):
+            os.unlink(self.job_script)
+
+
+class BatchExecutor(object):
+    '''Submit scripts to a batch scheduler
+
+    Parameters
+    ----------
+    scheduler : object
+        Scheduler object (e.g., `SlurmScheduler` or `LocalQueue`)
+    workdir : str, optional
+        Directory where scripts are written. This must be visible from the
+        compute nodes (default: current directory)
+    poll_interval : float, optional (default: 10)
+        How often (in seconds) to ask the scheduler about job status
+    '''
+    def __init__(self, scheduler, workdir=None, poll_interval=10.):
+        self.scheduler = scheduler
+        self.workdir = os.path.abspath(workdir or '.')
+        self.poll_interval = poll_interval
+
+    def submit(self, script, ncpus=None, extra_args=[], resources=None):
+        '''Submit `script` to the scheduler
+
+        `resources` is a dictionary of hints for the scheduler: `ncpus`,
+        `memory` (in bytes), `name`, and `walltime` (in seconds).
+        '''
+        start = time.time()
+        script_name = _write_script(script, self.workdir)
+        cmdline = _ngless_cmdline(script_name, ncpus, extra_args)
+        job_script = _write_script(
+                '#!/bin/sh\nexec {}\n'.format(' '.join(shlex.quote(c) for c in cmdline)),
+                self.workdir,
+                suffix='.sh')
+        resources = dict(resources or {})
+        if isinstance(ncpus, int):
+            resources.setdefault('ncpus', ncpus)
+        written = time.time()
+        try:
+            job_id = self.scheduler.submit(job_script, resources)
+        except:
+            _unlink_all(script_name, job_script)
+            raise
+        job = BatchJob(cmdline, script_name, job_script, self.scheduler, job_id, self.poll_interval)
+        job.timings['write_script'] = (start, written)
+        job.timings['submit'] = (written, time.time())
+        return job
+
+
+class SlurmScheduler(object):
+    '''Submit jobs with `sbatch` and track them with `sacct`
+
+    Parameters
+    ----------
+    extra_args : list of str, optional
+        Extra arguments to `sbatch` (e.g., `['--partition=htc']`)
+    '''
+    _FINAL_STATES = ('COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE')
+
+    def __init__(self, extra_args=[]):
+        self.extra_args = extra_args
+        self.start_times = {}
+
+    def submit(self, job_script, resources):
+        cmdline = ['sbatch', '--parsable',
+                    '--output', os.path.splitext(job_script)[0] + '.log']
+        if resources.get('name'):
+            cmdline.extend(['--job-name', resources['name']])
+        if resources.get('ncpus'):
+            cmdline.extend(['--cpus-per-task', str(resources['ncpus'])])
+        if resources.get('memory'):
+            cmdline.extend(['--mem', '{}M'.format(-(-resources['memory'] // 2**20))])
+        if resources.get('walltime'):
+            cmdline.extend(['--time', str(-(-int(resources['walltime']) // 60))])
+        cmdline.extend(self.extra_args)
+        cmdline.append(job_script)
+        out = subprocess.check_output(cmdline).decode('ascii')
+        return out.strip().split(';')[0]
+
+    def status(self, job_id):
+        out = subprocess.check_output(
+                ['sacct', '--noheader', '--parsable2', '--allocations',
+                    '--jobs', job_id, '--format', 'State,ExitCode,Start']).decode('ascii')
+        for line in out.splitlines():
+            state, exitcode, start = line.split('|')
+            state = state.split()[0] if state else ''
+            if job_id not in self.start_times and start[:1].isdigit():
+                self.start_times[job_id] = time.mktime(time.strptime(start, '%Y-%m-%dT%H:%M:%S'))
+            if state not in self._FINAL_STATES:
+                return None
+            code, signal = exitcode.split(':')
+            if int(signal):
+                return -int(signal)
+            if state != 'COMPLETED' and not int(code):
+                return 1
+            return int(code)
+        # Not yet visible in the accounting database
+        return None
+
+    def start_time(self, job_id):
+        '''When the job started (None if unknown or still pending)'''
+        return self.start_times.get(job_id)
+
+    def cancel(self, job_id):
+        subprocess.check_call(['scancel', job_id])
+
+
+class LocalQueue(object):
+    '''Stand-in for a batch scheduler, running jobs on the local machine
+
+    Jobs are queued and started (in submission order) whenever fewer than
+    `max_running` are running. The resources requested are recorded (in the
+    `resources` dictionary, indexed by job id), but otherwise ignored.
+
+    Parameters
+    ----------
+    max_running : int, optional
+        Maximum number of concurrently running jobs (default: unlimited)
+    '''
+    def __init__(self, max_running=None):
+        self.max_running = max_running
+        self.next_id = 0
+        self.pending = []
+        self.running = {}
+        self.finished = {}
+        self.resources = {}
+        self.start_times = {}
+        self.lock = threading.Lock()
+
+    def _pump(self):
+        for job_id, p in list(self.running.items()):
+            if p.poll() is not None:
+                self.finished[job_id] = p.returncode
+                del self.running[job_id]
+        while self.pending and (self.max_running is None or len(self.running) < self.max_running):
+            job_id, job_script = self.pending.pop(0)
+            self.running[job_id] = subprocess.Popen(['/bin/sh', job_script])
+            self.start_times[job_id] = time.time()
+
+    def submit(self, job_script, resources):
+        with self.lock:
+            job_id = str(self.next_id)
+            self.next_id += 1
+            self.resources[job_id] = resources
+            self.pending.append((job_id, job_script))
+            self._pump()
+            return job_id
+
+    def status(self, job_id):
+        with self.lock:
+            self._pump()
+            return self.finished.get(job_id)
+
+    def start_time(self, job_id):
+        with self.lock:
+            return self.start_times.get(job_id)
+
+    def cancel(self, job_id):
+        with self.lock:
+            for ix, (jid, _) in enumerate(self.pending):
+                if jid == job_id:
+                    del self.pending[ix]
+                    self.finished[job_id] = -9
+            if job_id in self.running:
+                self.running[job_id].kill()
+                self.running[job_id].wait()
+            self._pump()
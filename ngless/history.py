@@ -0,0 +1,157 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+'''
+Local history of NGLess runs
+
+Every call to `NGLess.run` is recorded in a local SQLite database (by default
+`~/.cache/nglesspy/history.sqlite`, which can be changed with the
+`NGLESSPY_HISTORY` environment variable). The history is used to pick the
+number of threads when calling `NGLess.run(ncpus='tuned')`: for jobs with
+the same shape (the set of functions used) and a similar input size, the
+smallest thread count which achieves (nearly) the best observed throughput
+is used.
+'''
+
+import os
+import sqlite3
+
+from . import NGLess as ngl
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    timestamp REAL,
+    shape TEXT,
+    input_bytes INTEGER,
+    ncpus INTEGER,
+    wall_time REAL,
+    peak_rss INTEGER,
+    success INTEGER
+)
+'''
+
+def default_path():
+    '''Path of the history database'''
+    return os.environ.get('NGLESSPY_HISTORY',
+                os.path.expanduser('~/.cache/nglesspy/history.sqlite'))
+
+def script_shape(sc):
+    '''Summarize a script as the (sorted) list of functions it uses'''
+    fnames = set()
+    for e in ngl.walk(sc.script):
+        if isinstance(e, ngl.FunctionCall):
+            fnames.add(e.fname)
+        elif isinstance(e, ngl.PairedCalled):
+            fnames.add('paired')
+    return ','.join(sorted(fnames))
+
+def input_size(sc):
+    '''Total size (in bytes) of the input files of a script'''
+    return sum(os.path.getsize(f) for f in set(sc.input_files()) if os.path.isfile(f))
+
+def _effective_ncpus(ncpus):
+    if ncpus == 'auto':
+        return os.cpu_count() or 1
+    return int(ncpus) if ncpus else 1
+
+
+class RunHistory(object):
+    '''Database of previous runs
+
+    Parameters
+    ----------
+    path : str, optional
+        Database file (default: see `default_path()`)
+    '''
+    def __init__(self, path=None):
+        self.path = (path or default_path())
+
+    def _connect(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute(_SCHEMA)
+        return conn
+
+    def record(self, sc, ncpus, wall_time, peak_rss, success=True):
+        '''Record a run of script `sc`'''
+        import time
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (time.time(),
+                            script_shape(sc),
+                            input_size(sc),
+                            _effective_ncpus(ncpus),
+                            wall_time,
+                            peak_rss,
+                            int(success)))
+        finally:
+            conn.close()
+
+    def tune(self, sc, tolerance=0.9):
+        '''Pick resources for script `sc` based on similar previous runs
+
+        Runs are similar if they have the same shape and input sizes within a
+        factor of 4.
+
+        Parameters
+        ----------
+        sc : NGLess
+        tolerance : float, optional (default: 0.9)
+            The smallest number of threads whose median throughput is at least
+            `tolerance` times the best one is chosen
+
+        Returns
+        -------
+        resources : (int, int) or None
+            `(ncpus, peak_rss)` where `peak_rss` is the largest peak memory
+            usage (in bytes, or None if unknown) observed with that number of
+            threads. None if there is no similar run in the history.
+        '''
+        nbytes = input_size(sc)
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                    'SELECT ncpus, input_bytes, wall_time, peak_rss FROM runs '
+                    'WHERE success = 1 AND shape = ? AND wall_time > 0 '
+                    'AND input_bytes BETWEEN ? AND ?',
+                    (script_shape(sc), nbytes // 4, nbytes * 4)).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return None
+        throughput = {}
+        memory = {}
+        for ncpus, ibytes, wall_time, peak_rss in rows:
+            throughput.setdefault(ncpus, []).append(max(ibytes, 1) / wall_time)
+            if peak_rss is not None:
+                memory[ncpus] = max(memory.get(ncpus, 0), peak_rss)
+        median = {}
+        for ncpus, values in throughput.items():
+            values.sort()
+            median[ncpus] = values[len(values) // 2]
+        best = max(median.values())
+        ncpus = min(n for n, t in median.items() if t >= tolerance * best)
+        return ncpus, memory.get(ncpus)
+
+
+def tuned_resources(sc, path=None, default='auto'):
+    '''Resources to use for `sc` according to the history
+
+    Returns
+    -------
+    ncpus : int or str
+        Number of threads (`default` if no similar runs were recorded)
+    memory : int or None
+        Peak memory seen with that number of threads (in bytes)
+    '''
+    try:
+        tuned = RunHistory(path).tune(sc)
+    except (sqlite3.Error, OSError):
+        # e.g., the history directory cannot be created (read-only $HOME)
+        tuned = None
+    if tuned is None:
+        return default, None
+    return tuned
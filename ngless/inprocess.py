@@ -0,0 +1,260 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+'''
+In-process execution of simple preprocessing scripts
+
+For very small inputs, starting the ngless binary dominates the runtime of
+simple trimming scripts. This module interprets the subset of NGLess that is
+needed for these (``fastq``, ``preprocess`` with ``substrim``/``endstrim`` and
+length-based ``discard``, and ``write``) directly in Python, using NumPy to
+process the qualities of many reads at once.
+
+Anything outside of this subset raises ``UnsupportedScript`` so that the
+caller can fall back to running ngless.
+'''
+
+from . import NGLess as ngl
+
+BATCH_SIZE = 8192
+
+_LEN_OPERATORS = {
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+        }
+
+_ENCODINGS = {
+        '{33}': 33,
+        '{sanger}': 33,
+        '{64}': 64,
+        '{solexa}': 64,
+        }
+
+class UnsupportedScript(NotImplementedError):
+    '''The script uses features which cannot be executed in-process'''
+    pass
+
+
+def _literal_int(val):
+    if isinstance(val, ngl.Literal):
+        val = val.val
+    if isinstance(val, bool) or not isinstance(val, int):
+        raise UnsupportedScript("Expected an integer, got {!r}".format(val))
+    return val
+
+def _literal_str(val):
+    if isinstance(val, ngl.Literal):
+        val = val.val
+    if not isinstance(val, str):
+        raise UnsupportedScript("Expected a string, got {!r}".format(val))
+    return val
+
+def _is_block_var(e, bvar):
+    return isinstance(e, ngl.NGLessVariable) and e.name == bvar.name
+
+
+def _compile_block(block):
+    '''Transform the body of a preprocess block into a list of operations'''
+    ops = []
+    bvar = block.bvar
+    for st in block.block:
+        if isinstance(st, ngl.Assignment) \
+                and _is_block_var(st.var, bvar) \
+                and isinstance(st.expression, ngl.FunctionCall) \
+                and st.expression.fname in ('substrim', 'endstrim') \
+                and st.expression.block is None \
+                and _is_block_var(st.expression.arg, bvar):
+            kwargs = dict(st.expression.kwargs)
+            if 'min_quality' not in kwargs:
+                raise UnsupportedScript("{} without min_quality".format(st.expression.fname))
+            min_quality = _literal_int(kwargs.pop('min_quality'))
+            from_ends = '{both}'
+            if st.expression.fname == 'endstrim':
+                from_ends = kwargs.pop('from_ends', '{both}')
+                if from_ends not in ('{both}', '{3}', '{5}'):
+                    raise UnsupportedScript("endstrim(from_ends={})".format(from_ends))
+            if kwargs:
+                raise UnsupportedScript("Unsupported arguments to {}: {}".format(st.expression.fname, sorted(kwargs)))
+            ops.append((st.expression.fname, min_quality, from_ends))
+        elif isinstance(st, ngl.IFExpression) \
+                and st.ifFalse is None \
+                and isinstance(st.ifTrue, ngl.NGLessKeyword) \
+                and st.ifTrue.keyword == 'discard' \
+                and isinstance(st.cond, ngl.BinaryOp) \
+                and st.cond.op in _LEN_OPERATORS \
+                and isinstance(st.cond.right, ngl.FunctionCall) \
+                and st.cond.right.fname == 'len' \
+                and not st.cond.right.kwargs \
+                and _is_block_var(st.cond.right.arg, bvar):
+            ops.append(('discard', st.cond.op, _literal_int(st.cond.left)))
+        else:
+            raise UnsupportedScript("Unsupported statement in preprocess block: {}".format(st.generate().strip()))
+    return ops
+
+
+def compile_script(script):
+    '''Compile an NGLess object into a list of (input, encoding, ops, ofile)
+
+    Raises ``UnsupportedScript`` if the script cannot be executed in-process.
+    '''
+    if script.modules:
+        raise UnsupportedScript("Module imports are not supported")
+    variables = {}
+    outputs = []
+    for e in script.script:
+        if isinstance(e, ngl.Assignment):
+            expr = e.expression
+            if not isinstance(expr, ngl.FunctionCall):
+                raise UnsupportedScript("Unsupported expression: {}".format(e.generate()))
+            if expr.fname == 'fastq' and expr.block is None:
+                kwargs = dict(expr.kwargs)
+                encoding = kwargs.pop('encoding', '{auto}')
+                if kwargs or (encoding != '{auto}' and encoding not in _ENCODINGS):
+                    raise UnsupportedScript("Unsupported arguments to fastq: {}".format(e.generate()))
+                source = _literal_str(expr.arg)
+                if source.endswith(('.xz', '.zst')):
+                    # Compressed formats which `_open_mode` cannot read
+                    raise UnsupportedScript("Unsupported input format: {}".format(source))
+                variables[e.var.name] = (source, _ENCODINGS.get(encoding), [])
+            elif expr.fname == 'preprocess' \
+                    and isinstance(expr.arg, ngl.NGLessVariable) \
+                    and expr.arg.name in variables \
+                    and isinstance(expr.block, ngl.Block) \
+                    and set(expr.kwargs) <= set(['keep_singles']):
+                source, encoding, ops = variables[expr.arg.name]
+                variables[e.var.name] = (source, encoding, ops + _compile_block(expr.block))
+            else:
+                raise UnsupportedScript("Unsupported expression: {}".format(e.generate()))
+        elif isinstance(e, ngl.FunctionCall) and e.fname == 'write':
+            kwargs = dict(e.kwargs)
+            ofile = _literal_str(kwargs.pop('ofile', None))
+            if kwargs \
+                    or not isinstance(e.arg, ngl.NGLessVariable) \
+                    or e.arg.name not in variables:
+                raise UnsupportedScript("Unsupported write call: {}".format(e.generate()))
+            if _open_mode(ofile) is None:
+                raise UnsupportedScript("Unsupported output format: {}".format(ofile))
+            source, encoding, ops = variables[e.arg.name]
+            outputs.append((source, encoding, ops, ofile))
+        else:
+            raise UnsupportedScript("Unsupported expression: {}".format(e.generate()))
+    return outputs
+
+
+def _open_mode(fname):
+    if fname.endswith('.gz'):
+        import gzip
+        return gzip.open
+    if fname.endswith('.bz2'):
+        import bz2
+        return bz2.open
+    if fname.endswith(('.fq', '.fastq')):
+        return open
+    return None
+
+def _read_batches(fname):
+    opener = _open_mode(fname) or open
+    with opener(fname, 'rb') as ifile:
+        batch = []
+        while True:
+            header = ifile.readline()
+            if not header:
+                break
+            seq = ifile.readline().rstrip(b'\r\n')
+            ifile.readline()
+            qual = ifile.readline().rstrip(b'\r\n')
+            if len(seq) != len(qual):
+                raise ValueError("Malformed FastQ file '{}' (sequence and quality lengths differ)".format(fname))
+            batch.append((header, seq, qual))
+            if len(batch) == BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def _process_batch(batch, offset, ops):
+    '''Apply ops to a batch, returning (start, length, keep) arrays'''
+    import numpy as np
+    n = len(batch)
+    lens = np.array([len(q) for _, _, q in batch], dtype=np.int64)
+    width = max(1, int(lens.max()))
+    cols = np.arange(width)
+    valid = cols < lens[:, None]
+    quals = np.zeros((n, width), dtype=np.uint8)
+    quals[valid] = np.frombuffer(b''.join(q for _, _, q in batch), dtype=np.uint8)
+
+    rows = np.arange(n)
+    start = np.zeros(n, dtype=np.int64)
+    length = lens.copy()
+    keep = np.ones(n, dtype=bool)
+    for op in ops:
+        if op[0] == 'discard':
+            _, cmp, val = op
+            keep &= ~_LEN_OPERATORS[cmp](length, val)
+            continue
+        fname, min_quality, from_ends = op
+        window = (cols >= start[:, None]) & (cols < (start + length)[:, None])
+        good = window & (quals >= offset + min_quality)
+        if fname == 'substrim':
+            # Length of the run of good bases ending at each position
+            total = np.cumsum(good, axis=1)
+            run = total - np.maximum.accumulate(np.where(good, 0, total), axis=1)
+            end = run.argmax(axis=1)
+            length = run[rows, end]
+            start = np.where(length > 0, end - length + 1, 0)
+        else:
+            has_good = good.any(axis=1)
+            first = good.argmax(axis=1)
+            last = width - 1 - good[:, ::-1].argmax(axis=1)
+            if from_ends == '{3}':
+                first = start
+            elif from_ends == '{5}':
+                last = start + length - 1
+            length = np.where(has_good, last - first + 1, 0)
+            start = np.where(has_good, first, 0)
+    # Reads trimmed down to nothing are dropped
+    keep &= (length > 0)
+    return start, length, keep
+
+
+def _guess_offset(batch):
+    lowest = min([min(q) for _, _, q in batch if q] or [64])
+    return 33 if lowest < 64 else 64
+
+
+def execute(script, verbose=True):
+    '''Execute the script in-process
+
+    Parameters
+    ----------
+    script : NGLess
+        NGLess script object
+    verbose : bool, optional (default: True)
+        Whether to print progress information
+
+    Raises
+    ------
+    UnsupportedScript
+        If the script (or the environment) does not allow for in-process
+        execution. Nothing has been written when this is raised.
+    '''
+    try:
+        import numpy # noqa (only needed to check availability)
+    except ImportError:
+        raise UnsupportedScript("numpy is not available")
+    outputs = compile_script(script)
+    for source, offset, ops, ofile in outputs:
+        if verbose:
+            print("Processing '{}' in-process (writing to '{}')".format(source, ofile))
+        with _open_mode(ofile)(ofile, 'wb') as out:
+            for batch in _read_batches(source):
+                if offset is None:
+                    offset = _guess_offset(batch)
+                start, length, keep = _process_batch(batch, offset, ops)
+                chunks = []
+                for (header, seq, qual), s, n, k in zip(batch, start.tolist(), length.tolist(), keep.tolist()):
+                    if k:
+                        chunks.append(b''.join([header, seq[s:s+n], b'\n+\n', qual[s:s+n], b'\n']))
+                out.write(b''.join(chunks))
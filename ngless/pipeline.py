@@ -0,0 +1,274 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+'''
+Concurrent execution of chained NGLess scripts
+
+When a script writes a file which a later script reads, running them through a
+`Pipeline` starts all scripts at once and replaces the intermediate file by a
+named pipe (FIFO), so that the stages run concurrently and the intermediate
+data never touches the disk.
+
+Example
+-------
+
+    from ngless.pipeline import Pipeline
+
+    trim = NGLess.NGLess('0.8')
+    ...
+    trim.write_(e.input, ofile='trimmed.fq')
+
+    mapping = NGLess.NGLess('0.8')
+    e = mapping.env
+    e.input = mapping.fastq_('trimmed.fq', encoding='{33}')
+    ...
+
+    Pipeline([trim, mapping]).run()
+
+Note that the file formats are still determined by the file extension, so
+the producer and the consumer must agree on it (e.g., writing a `.sam` file
+avoids compressing and decompressing BAM data).
+
+A FIFO can only be read once, so it is only used when the consumer is known
+to read its input in a single pass (see `NGLess._reads_once`: FastQ inputs
+need an explicit `encoding`, as otherwise ngless reads them twice to guess
+it). Otherwise, and for the files listed in `keep`, the intermediate file is
+written to disk and the consumer is only started once the producer has
+finished.
+
+ngless may also write some outputs to a temporary file which is then renamed
+onto the output path (replacing the FIFO). When this happens, the finished
+file is copied into the pipe that the consumer is waiting on.
+'''
+
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+
+from . import NGLess as ngl
+from .NGLess import _ngless_cmdline
+
+def _open_writer(fifo):
+    '''Open `fifo` for writing if a reader is waiting on it (None otherwise)'''
+    try:
+        return os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        # ENXIO: nobody has the FIFO open for reading
+        return None
+
+def _feed(spare, path):
+    '''Copy `path` into the FIFO `spare` if a reader is waiting on it
+
+    Returns the copying thread (or None if there was no reader)
+    '''
+    fd = _open_writer(spare)
+    if fd is None:
+        return None
+    os.set_blocking(fd, True)
+    def copy():
+        try:
+            with os.fdopen(fd, 'wb') as output, open(path, 'rb') as ifile:
+                shutil.copyfileobj(ifile, output, 1024 * 1024)
+        except BrokenPipeError:
+            # The consumer was killed
+            pass
+    t = threading.Thread(target=copy)
+    t.daemon = True
+    t.start()
+    return t
+
+def _has_open(pid, path):
+    '''Whether process `pid` has `path` open (None if unknown)'''
+    target = os.stat(path)
+    fddir = '/proc/{}/fd'.format(pid)
+    try:
+        fds = os.listdir(fddir)
+    except OSError:
+        return None
+    for fd in fds:
+        try:
+            st = os.stat(os.path.join(fddir, fd))
+        except OSError:
+            continue
+        if (st.st_dev, st.st_ino) == (target.st_dev, target.st_ino):
+            return True
+    return False
+
+def _is_fifo(path):
+    try:
+        return stat.S_ISFIFO(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+class Pipeline(object):
+    '''A list of NGLess scripts to be run concurrently
+
+    Parameters
+    ----------
+    stages : list of NGLess
+        The scripts. Each output of a stage which is read by exactly one later
+        stage is replaced by a FIFO (if the later stage reads it in a single
+        pass).
+    '''
+    def __init__(self, stages):
+        self.stages = list(stages)
+
+    def links(self):
+        '''Return the list of `(producer, consumer, path)` links
+
+        `producer` and `consumer` are indices into `stages`.
+        '''
+        links = []
+        for pi, producer in enumerate(self.stages):
+            for out in producer.output_files():
+                consumers = [ci
+                        for ci in range(pi + 1, len(self.stages))
+                        if os.path.abspath(out) in
+                            [os.path.abspath(f) for f in self.stages[ci].input_files()]]
+                if len(consumers) > 1:
+                    raise ValueError("File '{}' is read by more than one stage (a FIFO can only be read once)".format(out))
+                if consumers:
+                    links.append((pi, consumers[0], out))
+        return links
+
+    def _streamable(self, consumer, path):
+        '''Whether stage `consumer` reads `path` in a single pass'''
+        return all(ngl._reads_once(node)
+                    for node, holder, key in ngl._file_slots(self.stages[consumer].script)
+                    if not ngl._is_output_slot(node)
+                        and os.path.abspath(holder[key]) == os.path.abspath(path))
+
+    def run(self, auto_install=True, verbose=True, ncpus=None, extra_args=[], poll_interval=0.1, keep=[], timeout=None):
+        '''Run all stages concurrently
+
+        Parameters
+        ----------
+        auto_install : bool, optional (default: True)
+            If true, then ngless is installed if not available in the PATH
+        verbose : bool, optional (default: True)
+            Whether to print the scripts before executing them
+        ncpus : int or str or list, optional
+            CPUs to use for each stage (a single value or one per stage)
+        extra_args : list of str, optional
+            Extra arguments to pass to ngless
+        poll_interval : float, optional
+            How often (in seconds) to check on the stages
+        keep : list of str, optional
+            Intermediate files which should be written to disk (the stages
+            reading them wait until they are complete)
+        timeout : float, optional
+            Maximum time (in seconds) for the whole pipeline
+
+        Raises
+        ------
+        subprocess.CalledProcessError
+            If any stage fails (all other stages are then terminated)
+        subprocess.TimeoutExpired
+            If `timeout` is exceeded
+        RuntimeError
+            If a stage finishes without writing an output that a later stage
+            is waiting for
+        '''
+        if auto_install:
+            from . import install
+            install.install_ngless(verbose=verbose)
+        if not isinstance(ncpus, list):
+            ncpus = [ncpus for _ in self.stages]
+        keep = set(os.path.abspath(f) for f in keep)
+        tdir = tempfile.mkdtemp(prefix='nglesspy-pipeline-')
+        procs = {}
+        feeders = []
+        start = time.time()
+        try:
+            links = self.links()
+            on_disk = set(ix for ix, (_, consumer, path) in enumerate(links)
+                            if os.path.abspath(path) in keep or not self._streamable(consumer, path))
+            # All links into or out of a stage which is started late go
+            # through the disk: otherwise, a stage blocked on a FIFO could be
+            # what the late stage is (indirectly) waiting for
+            while True:
+                late = set(links[ix][1] for ix in on_disk)
+                extra = set(ix for ix, (producer, consumer, _) in enumerate(links)
+                            if ix not in on_disk and (producer in late or consumer in late))
+                if not extra:
+                    break
+                on_disk.update(extra)
+            waits_for = [set() for _ in self.stages]
+            for ix in on_disk:
+                waits_for[links[ix][1]].add(links[ix][0])
+
+            mappings = [{} for _ in self.stages]
+            fifos = [[] for _ in self.stages]
+            orphans = []
+            for ix, (producer, consumer, path) in enumerate(links):
+                if ix in on_disk:
+                    if verbose:
+                        print("Writing '{}' to disk (stage {} waits for stage {})".format(path, consumer, producer))
+                    continue
+                fifo = os.path.join(tdir, 'link{}'.format(ix), os.path.basename(path))
+                os.mkdir(os.path.dirname(fifo))
+                os.mkfifo(fifo)
+                # Second name for the FIFO, so that it can still be reached if
+                # the producer replaces it
+                spare = os.path.join(tdir, 'link{}.fifo'.format(ix))
+                os.link(fifo, spare)
+                fifos[producer].append((consumer, fifo, spare))
+                mappings[producer][path] = fifo
+                for f in self.stages[consumer].input_files():
+                    if os.path.abspath(f) == os.path.abspath(path):
+                        mappings[consumer][f] = fifo
+
+            finished = set()
+            while len(finished) < len(self.stages):
+                for ix, sc in enumerate(self.stages):
+                    if ix not in procs and waits_for[ix] <= finished:
+                        script = sc.with_paths(mappings[ix]).generate()
+                        if verbose:
+                            print(script)
+                        script_name = os.path.join(tdir, 'stage{}.ngl'.format(ix))
+                        with open(script_name, 'w') as output:
+                            output.write(script)
+                        procs[ix] = subprocess.Popen(_ngless_cmdline(script_name, ncpus[ix], extra_args))
+                for ix, p in list(procs.items()):
+                    if ix in finished or p.poll() is None:
+                        continue
+                    if p.returncode != 0:
+                        raise subprocess.CalledProcessError(p.returncode, p.args)
+                    finished.add(ix)
+                    for consumer, fifo, spare in fifos[ix]:
+                        if _is_fifo(fifo):
+                            orphans.append((ix, consumer, fifo, spare))
+                        else:
+                            if verbose:
+                                print("Stage {} replaced the pipe '{}' by a file; copying it to stage {}".format(ix, fifo, consumer))
+                            t = _feed(spare, fifo)
+                            if t is not None:
+                                feeders.append(t)
+                for producer, consumer, fifo, spare in orphans:
+                    # The producer has exited, so a consumer which is opening
+                    # the FIFO now (rather than reading what is left in it)
+                    # would wait forever for a writer
+                    if consumer in finished or _has_open(procs[consumer].pid, spare) is not False:
+                        continue
+                    fd = _open_writer(spare)
+                    if fd is not None:
+                        os.close(fd)
+                        raise RuntimeError("Stage {} finished without writing '{}' (which stage {} is waiting for)".format(producer, fifo, consumer))
+                if timeout is not None and time.time() - start > timeout:
+                    running = [p for ix, p in procs.items() if ix not in finished]
+                    raise subprocess.TimeoutExpired((running[0].args if running else []), timeout)
+                time.sleep(poll_interval)
+        finally:
+            # Stages blocked on a FIFO whose other end has died would hang
+            # forever, so everything still running is killed
+            for p in procs.values():
+                if p.poll() is None:
+                    p.kill()
+                    p.wait()
+            for t in feeders:
+                t.join()
+            shutil.rmtree(tdir, ignore_errors=True)
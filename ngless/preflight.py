@@ -0,0 +1,233 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+'''
+Pre-flight validation of FastQ inputs
+
+Before starting expensive jobs, `check_script` verifies that the FastQ inputs
+of a script are complete (the number of lines is a multiple of 4) and that
+paired-end files have matching numbers of records and matching headers. It
+also estimates the read length and total number of bases of every input.
+
+Uncompressed files are memory-mapped and newlines are counted in large
+chunks, which is close to disk bandwidth. Compressed files are streamed
+(`.zst` files through the `zstd` tool; if it is not installed, they are
+skipped).
+'''
+
+import os
+import subprocess
+
+from . import NGLess as ngl
+
+CHUNK_SIZE = 16 * 1024 * 1024
+SAMPLE_SIZE = 1000
+
+class PreflightError(ValueError):
+    '''An input failed pre-flight validation'''
+    pass
+
+
+class _ToolOutput(object):
+    '''Output of an external decompressor as a (read-only) file object'''
+    def __init__(self, cmdline):
+        self.proc = subprocess.Popen(cmdline, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def read(self, n=-1):
+        return self.proc.stdout.read(n)
+
+    def readline(self):
+        return self.proc.stdout.readline()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.proc.stdout.close()
+        if self.proc.poll() is None:
+            # Not read to the end
+            self.proc.kill()
+            self.proc.wait()
+        elif self.proc.returncode != 0 and exc_type is None:
+            raise PreflightError("File '{}' appears corrupted ({} failed)".format(self.proc.args[-1], self.proc.args[0]))
+
+
+def _can_decode(fname):
+    '''Whether `_scan` can read `fname` (i.e., it is not an undecodable `.zst` file)'''
+    from .decompress import decompressor_for
+    return not fname.endswith('.zst') or decompressor_for(fname) is not None
+
+def _open_compressed(fname):
+    if fname.endswith('.gz'):
+        import gzip
+        return gzip.open(fname, 'rb')
+    if fname.endswith('.bz2'):
+        import bz2
+        return bz2.open(fname, 'rb')
+    if fname.endswith('.xz'):
+        import lzma
+        return lzma.open(fname, 'rb')
+    if fname.endswith('.zst'):
+        from .decompress import decompressor_for
+        cmdline = decompressor_for(fname)
+        if cmdline is None:
+            raise PreflightError("Cannot read '{}' (zstd is not installed)".format(fname))
+        return _ToolOutput(cmdline)
+    return None
+
+def _read_name(header):
+    '''Read name without the mate suffix (/1 or /2) and comments'''
+    name = header.split()[0] if header.strip() else b''
+    if name[-2:] in (b'/1', b'/2'):
+        name = name[:-2]
+    return name
+
+def _scan(fname):
+    '''Returns (number of lines, first lines, last 4 lines) of a file'''
+    import mmap
+    compressed = _open_compressed(fname)
+    if compressed is not None:
+        nlines = 0
+        head = b''
+        tail = b''
+        with compressed:
+            while True:
+                chunk = compressed.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                nlines += chunk.count(b'\n')
+                if len(head) < CHUNK_SIZE:
+                    head += chunk
+                tail = (tail + chunk)[-CHUNK_SIZE:]
+        if tail and not tail.endswith(b'\n'):
+            nlines += 1
+        return nlines, head, tail
+    with open(fname, 'rb') as ifile:
+        if os.fstat(ifile.fileno()).st_size == 0:
+            return 0, b'', b''
+        mm = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            nlines = 0
+            for start in range(0, len(mm), CHUNK_SIZE):
+                nlines += mm[start:start + CHUNK_SIZE].count(b'\n')
+            # Files without a final newline still have a last line
+            if mm[-1:] != b'\n':
+                nlines += 1
+            return nlines, mm[:CHUNK_SIZE], mm[-CHUNK_SIZE:]
+        finally:
+            mm.close()
+
+
+def inspect_fastq(fname):
+    '''Count records and estimate sizes of a FastQ file
+
+    Returns
+    -------
+    stats : dict
+        With keys `file`, `records`, `read_length` (mean length of the first
+        records), `bases` (estimated total), `headers` (first read names) and
+        `last_header` (name of the last read)
+
+    Raises
+    ------
+    PreflightError
+        If the file is missing or truncated
+    '''
+    if not os.path.exists(fname):
+        raise PreflightError("Input file '{}' does not exist".format(fname))
+    nlines, head, tail = _scan(fname)
+    if head and not head.endswith(b'\n'):
+        head = head[:head.rfind(b'\n') + 1]
+    if nlines % 4 != 0:
+        raise PreflightError("File '{}' appears truncated ({} lines is not a multiple of 4)".format(fname, nlines))
+    lines = head.split(b'\n')
+    headers = lines[0:4 * SAMPLE_SIZE:4]
+    seqs = lines[1:4 * SAMPLE_SIZE:4]
+    nrecs = min(len(headers), len(seqs))
+    if nrecs and not headers[0].startswith(b'@'):
+        raise PreflightError("File '{}' does not look like a FastQ file".format(fname))
+    read_length = (sum(len(s) for s in seqs[:nrecs]) / nrecs if nrecs else 0.)
+    tail_lines = tail.rstrip(b'\n').split(b'\n')
+    last_header = (tail_lines[-4] if len(tail_lines) >= 4 else b'')
+    if nlines and (not last_header.startswith(b'@') or len(tail_lines[-3]) != len(tail_lines[-1])):
+        raise PreflightError("File '{}' appears truncated (last record is malformed)".format(fname))
+    records = nlines // 4
+    return {
+            'file': fname,
+            'records': records,
+            'read_length': read_length,
+            'bases': int(round(read_length * records)),
+            'headers': [_read_name(h) for h in headers[:nrecs]],
+            'last_header': _read_name(last_header),
+            }
+
+
+def check_paired(forward, reverse, singles=None):
+    '''Check a pair of FastQ files (plus an optional singles file)
+
+    Returns
+    -------
+    stats : list of dict
+        `inspect_fastq` results for each file
+
+    Raises
+    ------
+    PreflightError
+        If any file is invalid or the forward/reverse files do not match
+    '''
+    fstats = inspect_fastq(forward)
+    rstats = inspect_fastq(reverse)
+    if fstats['records'] != rstats['records']:
+        raise PreflightError("Paired files do not match: '{}' has {} records, but '{}' has {}".format(
+                    forward, fstats['records'], reverse, rstats['records']))
+    for fh, rh in zip(fstats['headers'], rstats['headers']):
+        if fh != rh:
+            raise PreflightError("Paired files do not match: read '{}' in '{}' is paired with '{}' in '{}'".format(
+                    fh.decode('utf-8', 'replace'), forward, rh.decode('utf-8', 'replace'), reverse))
+    if fstats['last_header'] != rstats['last_header']:
+        raise PreflightError("Paired files do not match: last reads in '{}' and '{}' differ".format(forward, reverse))
+    stats = [fstats, rstats]
+    if singles is not None:
+        stats.append(inspect_fastq(singles))
+    return stats
+
+
+def check_script(sc, verbose=True):
+    '''Check all `fastq` and `paired` inputs of a script
+
+    Inputs which are not plain strings (e.g., variables) are skipped, as are
+    `.zst` files if zstd is not installed.
+
+    Returns
+    -------
+    stats : list of dict
+        `inspect_fastq` results for each checked file
+
+    Raises
+    ------
+    PreflightError
+    '''
+    def path_of(arg):
+        if isinstance(arg, ngl.Literal) and isinstance(arg.val, str):
+            return arg.val
+        return None
+    def readable(*fnames):
+        for f in fnames:
+            if f is not None and not _can_decode(f):
+                print("Pre-flight: skipping '{}' (zstd is not installed)".format(f))
+                return False
+        return True
+    stats = []
+    for e in ngl.walk(sc.script):
+        if isinstance(e, ngl.FunctionCall) and e.fname == 'fastq' and path_of(e.arg):
+            if readable(path_of(e.arg)):
+                stats.append(inspect_fastq(path_of(e.arg)))
+        elif isinstance(e, ngl.PairedCalled) and path_of(e.arg1) and path_of(e.arg2):
+            singles = e.kwargs.get('singles')
+            singles = (singles if isinstance(singles, str) else None)
+            if readable(path_of(e.arg1), path_of(e.arg2), singles):
+                stats.extend(check_paired(path_of(e.arg1), path_of(e.arg2), singles))
+    if verbose:
+        for st in stats:
+            print("Pre-flight: '{}': {} reads (mean length {:.1f}), ~{} bases".format(
+                        st['file'], st['records'], st['read_length'], st['bases']))
+    return stats
@@ -0,0 +1,280 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+'''
+Preview runs on a subsample of the input
+
+`preview` runs a script on the first N reads (or a random sample of N reads)
+of each `fastq`/`paired` input, writing all outputs to a temporary directory.
+The observed runtime and output sizes are extrapolated to the full input and,
+for every `map` call in the script, the mapping rate is reported (computed by
+`mapstats`).
+
+The extrapolation is linear, so fixed costs (e.g., starting ngless or loading
+an index) are overestimated for large inputs.
+
+With the 'head' method, only the start of each input is read and its total
+number of reads is itself estimated from the fraction of the file (of the
+compressed data, for compressed files) that was needed for the subsample.
+The 'reservoir' method reads the whole input and counts all reads.
+'''
+
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from . import NGLess as ngl
+from .preflight import inspect_fastq, _open_compressed
+
+class _RecordReader(object):
+    '''Iterates over the records of a FastQ file, tracking how much of the
+    file has been read'''
+    def __init__(self, fname):
+        self.fname = fname
+        self.nrecords = 0
+        self.eof = False
+        # (records read, bytes of `fname` read) when the decompressor last
+        # needed more input (so that read-ahead is not counted)
+        self.checkpoint = (0, 0)
+        self.raw = None
+        if fname.endswith('.zst'):
+            # Decompressed by an external tool: progress is unknown
+            self.ifile = _open_compressed(fname)
+            return
+        self.raw = open(fname, 'rb')
+        if fname.endswith('.gz'):
+            import gzip
+            self.ifile = gzip.GzipFile(fileobj=self.raw, mode='rb')
+        elif fname.endswith('.bz2'):
+            import bz2
+            self.ifile = bz2.BZ2File(self.raw)
+        elif fname.endswith('.xz'):
+            import lzma
+            self.ifile = lzma.LZMAFile(self.raw)
+        else:
+            self.ifile = self.raw
+
+    def __iter__(self):
+        try:
+            with self.ifile:
+                while True:
+                    pos = (self.raw.tell() if self.raw is not None else None)
+                    rec = [self.ifile.readline() for _ in range(4)]
+                    if not rec[0]:
+                        self.eof = True
+                        return
+                    if pos is not None and self.raw.tell() != pos:
+                        self.checkpoint = (self.nrecords, pos)
+                    self.nrecords += 1
+                    yield b''.join(rec)
+        finally:
+            if self.raw is not None:
+                self.raw.close()
+
+    def has_estimate(self):
+        return self.eof or self.checkpoint[1] > 0
+
+    def estimate_total(self):
+        '''Estimated number of records in the file (None if unknown)'''
+        if self.eof:
+            return self.nrecords
+        nrecords, pos = self.checkpoint
+        if pos == 0:
+            return None
+        return int(round(nrecords * os.path.getsize(self.fname) / pos))
+
+
+def _subsample(sources, targets, n, method, seed):
+    '''Implements `subsample`, returning the number of records written and the
+    `_RecordReader` objects'''
+    if method not in ('head', 'reservoir'):
+        raise ValueError("Unknown subsampling method '{}' (expected 'head' or 'reservoir')".format(method))
+    sample = []
+    rng = random.Random(seed)
+    readers = [_RecordReader(s) for s in sources]
+    iters = [iter(r) for r in readers]
+    for ix, recs in enumerate(zip(*iters)):
+        if ix < n:
+            sample.append((ix, recs))
+        elif method == 'head':
+            break
+        else:
+            j = rng.randint(0, ix)
+            if j < n:
+                sample[j] = (ix, recs)
+    if method == 'head':
+        # Read on until the amount of input consumed is known
+        for r, it in zip(readers, iters):
+            while not r.has_estimate() and r.raw is not None and next(it, None) is not None:
+                pass
+    for it in iters:
+        it.close()
+    sample.sort(key=lambda s: s[0])
+    for fx, target in enumerate(targets):
+        with open(target, 'wb') as output:
+            for _, recs in sample:
+                output.write(recs[fx])
+    return len(sample), readers
+
+def subsample(sources, targets, n, method='head', seed=None):
+    '''Write `n` records of each of `sources` to the corresponding `targets`
+
+    Files are processed in lockstep so that paired files are sampled
+    consistently.
+
+    Parameters
+    ----------
+    sources : list of str
+    targets : list of str
+    n : int
+    method : str, optional
+        Either 'head' (first `n` records) or 'reservoir' (uniform random
+        sample of `n` records, in their original order)
+    seed : int, optional
+        Random seed (for 'reservoir')
+
+    Returns
+    -------
+    nrecords : int
+        Number of records written to each target
+    '''
+    nrecords, _ = _subsample(sources, targets, n, method, seed)
+    return nrecords
+
+
+def _uncompressed_name(fname):
+    base = os.path.basename(fname)
+    for ext in ('.gz', '.bz2', '.xz', '.zst'):
+        if base.endswith(ext):
+            return base[:-len(ext)]
+    return base
+
+def _read_mapstats(fname):
+    stats = {}
+    with open(fname) as ifile:
+        for line in ifile:
+            tokens = line.rstrip('\n').split('\t')
+            if tokens[0] in ('total', 'aligned', 'unique'):
+                stats[tokens[0]] = int(tokens[-1])
+    return stats
+
+
+def preview(sc, n=10000, method='head', seed=None, verbose=True, **run_args):
+    '''Run `sc` on a subsample of its inputs
+
+    Parameters
+    ----------
+    sc : NGLess
+    n : int, optional (default: 10000)
+        Number of reads to use from each input
+    method : str, optional
+        'head' (first reads) or 'reservoir' (random sample)
+    seed : int, optional
+        Random seed for 'reservoir'
+
+    Other arguments are passed to `NGLess.run`
+
+    Returns
+    -------
+    report : dict
+        With keys `reads` (number of reads used), `total_reads`, `elapsed`
+        (seconds), `throughput` (reads per second), `estimated_time`
+        (seconds, for the full input), `estimated_outputs` (estimated size in
+        bytes of each output file) and `mapping_rates` (fraction of aligned
+        reads, for each variable assigned the result of `map`). With the
+        'head' method, `total_reads` is an estimate.
+
+    Raises
+    ------
+    ValueError
+        If the script has no `fastq`/`paired` inputs given as file names
+    '''
+    tdir = tempfile.mkdtemp(prefix='nglesspy-preview-')
+    try:
+        groups = []
+        for e in ngl.walk(sc.script):
+            if isinstance(e, ngl.FunctionCall) and e.fname == 'fastq' \
+                    and isinstance(e.arg, ngl.Literal) and isinstance(e.arg.val, str):
+                groups.append([e.arg.val])
+            elif isinstance(e, ngl.PairedCalled):
+                groups.append([a.val for a in (e.arg1, e.arg2)
+                            if isinstance(a, ngl.Literal) and isinstance(a.val, str)])
+                if isinstance(e.kwargs.get('singles'), str):
+                    groups.append([e.kwargs['singles']])
+        groups = [g for g in groups if g]
+        if not groups:
+            raise ValueError("Cannot preview a script without `fastq`/`paired` inputs given as file names")
+        mapping = {}
+        reads = 0
+        total_reads = 0
+        for ix, group in enumerate(groups):
+            targets = [os.path.join(tdir, 'in{}_{}'.format(ix, fx), _uncompressed_name(f))
+                        for fx, f in enumerate(group)]
+            for t in targets:
+                os.mkdir(os.path.dirname(t))
+            nrecs, readers = _subsample(group, targets, n, method, seed)
+            reads += nrecs * len(group)
+            for r in readers:
+                total = r.estimate_total()
+                total_reads += (total if total is not None else inspect_fastq(r.fname)['records'])
+            mapping.update(zip(group, targets))
+        outputs = {}
+        for ix, f in enumerate(sc.output_files()):
+            outputs[f] = os.path.join(tdir, 'out{}'.format(ix), os.path.basename(f))
+            os.mkdir(os.path.dirname(outputs[f]))
+            mapping[f] = outputs[f]
+
+        psc = sc.with_paths(mapping)
+        mapstats = {}
+        for ix, e in reversed(list(enumerate(psc.script))):
+            if isinstance(e, ngl.Assignment) \
+                    and isinstance(e.expression, ngl.FunctionCall) \
+                    and e.expression.fname == 'map':
+                ofile = os.path.join(tdir, 'mapstats{}.txt'.format(ix))
+                mapstats.setdefault(e.var.name, ofile)
+                psc.script.insert(ix + 1,
+                        ngl.FunctionCall('write',
+                            ngl.FunctionCall('mapstats', e.var, {}, None),
+                            {'ofile': ofile},
+                            None))
+
+        run_args.setdefault('history', False)
+        start = time.time()
+        psc.run(verbose=verbose, **run_args)
+        elapsed = time.time() - start
+
+        fraction = (reads / total_reads if total_reads else 1.)
+        report = {
+                'reads': reads,
+                'total_reads': total_reads,
+                'elapsed': elapsed,
+                'throughput': (reads / elapsed if elapsed > 0 else 0.),
+                'estimated_time': (elapsed / fraction if fraction else 0.),
+                'estimated_outputs': dict(
+                    (f, int(os.path.getsize(p) / fraction) if fraction and os.path.exists(p) else None)
+                        for f, p in outputs.items()),
+                'mapping_rates': {},
+                }
+        for var, ofile in mapstats.items():
+            if os.path.exists(ofile):
+                st = _read_mapstats(ofile)
+                if st.get('total'):
+                    report['mapping_rates'][var] = st.get('aligned', 0) / st['total']
+        return report
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+
+def format_report(report):
+    '''Format a report (as returned by `preview`) for printing'''
+    lines = [
+        'Preview used {} of {} reads ({:.1f}s, {:.0f} reads/s)'.format(
+            report['reads'], report['total_reads'], report['elapsed'], report['throughput']),
+        'Estimated time for the full input: {:.0f}s'.format(report['estimated_time']),
+        ]
+    for f, size in sorted(report['estimated_outputs'].items()):
+        lines.append("Estimated size of '{}': {}".format(f, ('unknown' if size is None else '{} bytes'.format(size))))
+    for var, rate in sorted(report['mapping_rates'].items()):
+        lines.append("Mapping rate ({}): {:.1%}".format(var, rate))
+    return '\n'.join(lines)
@@ -0,0 +1,142 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+'''
+Profiling of script construction and execution
+
+Profiling is enabled per script with `NGLess(version, profile=True)` (or by
+passing a shared `Profiler` object, which is useful for batches), or for all
+scripts by setting the `NGLESSPY_PROFILE` environment variable to the path of
+an output file, which is written when Python exits.
+
+The following phases are recorded (as event names):
+
+- `getattr:<name>` and `build:<function>`: building the script (`sc.map_`,...)
+- `generate:<node type>`: generating the NGLess code for each statement
+- `install_ngless`: checking for (and possibly installing) ngless
+- `write_script`: writing the script to a temporary file
+- `spawn`: starting the ngless process (`submit` for batch schedulers)
+- `execute`: running ngless
+
+Events are exported as JSON lines or in the Chrome trace format (which can be
+loaded in `chrome://tracing` or https://ui.perfetto.dev).
+
+Example
+-------
+
+    prof = profiling.Profiler()
+    for sample in samples:
+        sc = NGLess.NGLess('1.0', profile=prof)
+        ...
+        sc.run()
+    print(prof.format_summary())
+    prof.write('trace.json')
+'''
+
+import atexit
+import json
+import os
+import threading
+
+class Profiler(object):
+    '''Collects timed events
+
+    Attributes
+    ----------
+    events : list of dict
+        Events with keys `name`, `cat` (category), `start`, `end` (as
+        returned by `time.time()`), `pid`, `tid` and `args`
+    '''
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        # Copies of a script (e.g., from `NGLess.with_paths`) keep recording
+        # into the same profiler
+        return self
+
+    def record(self, name, cat, start, end, **args):
+        '''Record an event which ran from `start` to `end`'''
+        event = {
+            'name': name,
+            'cat': cat,
+            'start': start,
+            'end': end,
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': args,
+            }
+        with self.lock:
+            self.events.append(event)
+
+    def summary(self):
+        '''Aggregate events by name
+
+        Returns
+        -------
+        summary : dict
+            Maps event names to dictionaries with keys `count`, `total`,
+            `mean` and `max` (times in seconds)
+        '''
+        summary = {}
+        for ev in self.events:
+            dur = ev['end'] - ev['start']
+            s = summary.setdefault(ev['name'], {'count': 0, 'total': 0., 'max': 0.})
+            s['count'] += 1
+            s['total'] += dur
+            s['max'] = max(s['max'], dur)
+        for s in summary.values():
+            s['mean'] = s['total'] / s['count']
+        return summary
+
+    def format_summary(self):
+        '''Format `summary()` as a table (sorted by total time)'''
+        lines = ['{:<32} {:>8} {:>10} {:>10} {:>10}'.format('phase', 'count', 'total (s)', 'mean (ms)', 'max (ms)')]
+        for name, s in sorted(self.summary().items(), key=lambda ns: -ns[1]['total']):
+            lines.append('{:<32} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                        name, s['count'], s['total'], 1000. * s['mean'], 1000. * s['max']))
+        return '\n'.join(lines)
+
+    def write_jsonl(self, path):
+        '''Append all events to `path` (one JSON object per line)'''
+        with open(path, 'a') as output:
+            for ev in self.events:
+                output.write(json.dumps(ev))
+                output.write('\n')
+
+    def write_chrome_trace(self, path):
+        '''Write all events to `path` in the Chrome trace format'''
+        trace = [{
+                'name': ev['name'],
+                'cat': ev['cat'],
+                'ph': 'X',
+                'ts': int(ev['start'] * 1e6),
+                'dur': int((ev['end'] - ev['start']) * 1e6),
+                'pid': ev['pid'],
+                'tid': ev['tid'],
+                'args': ev['args'],
+                } for ev in self.events]
+        with open(path, 'w') as output:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, output)
+
+    def write(self, path):
+        '''Write events to `path` (Chrome trace format if it ends with
+        `.json`, JSON lines otherwise)'''
+        if path.endswith('.json'):
+            self.write_chrome_trace(path)
+        else:
+            self.write_jsonl(path)
+
+
+_default = None
+
+def default_profiler():
+    '''Return the profiler enabled by `NGLESSPY_PROFILE` (None if not set)'''
+    global _default
+    path = os.environ.get('NGLESSPY_PROFILE')
+    if not path:
+        return None
+    if _default is None:
+        _default = Profiler()
+        atexit.register(_default.write, path)
+    return _default
@@ -0,0 +1,279 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+'''
+Mapping against a sharded reference
+
+Very large references (e.g., gene catalogs) can be split into `nshards`
+pieces, the reads mapped against each piece in parallel (so that each
+process only needs to hold a fraction of the index in memory), and the
+results merged into a single alignment set keeping the best hits of each
+read.
+
+Example
+-------
+
+    from ngless import sharded, executors
+
+    sharded.map_sharded('reads.1.fq.gz', 'catalog.fna', 'mapped.bam', nshards=8,
+                    input_reverse='reads.2.fq.gz',
+                    executor=executors.PoolExecutor(4))
+
+The shards are kept (by default, in `catalog.fna.shards8/`) together with
+the indices that ngless builds for them, so that they are only split and
+indexed once. They are rebuilt if the reference is modified.
+
+The merge assumes that ngless writes the reads in the same order for every
+shard (which is the case as all shards map the same input).
+'''
+
+import os
+import shutil
+import tempfile
+
+from . import NGLess
+from .preflight import _open_compressed
+
+# Lists the shards of a complete shard directory
+SHARDS_LIST = 'shards.txt'
+
+def split_fasta(fasta, nshards, outdir):
+    '''Split a FASTA file into `nshards` files of similar size
+
+    Each sequence is assigned to the currently smallest shard.
+
+    Returns
+    -------
+    shards : list of str
+        Paths of the shard files (in `outdir`)
+    '''
+    shards = [os.path.join(outdir, 'shard{}.fna'.format(ix)) for ix in range(nshards)]
+    outputs = [open(s, 'wb') for s in shards]
+    sizes = [0 for _ in shards]
+    try:
+        ifile = _open_compressed(fasta) or open(fasta, 'rb')
+        with ifile:
+            current = None
+            for line in ifile:
+                if line.startswith(b'>'):
+                    current = sizes.index(min(sizes))
+                if current is None:
+                    continue
+                outputs[current].write(line)
+                sizes[current] += len(line)
+    finally:
+        for out in outputs:
+            out.close()
+    return [s for s, size in zip(shards, sizes) if size > 0]
+
+
+def _read_groups(ifile):
+    '''Yield (qname, records) for consecutive records of the same read'''
+    qname = None
+    records = []
+    for line in ifile:
+        if line.startswith('@'):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        if fields[0] != qname:
+            if records:
+                yield qname, records
+            qname = fields[0]
+            records = []
+        records.append(fields)
+    if records:
+        yield qname, records
+
+def _alignment_score(fields):
+    for tag in fields[11:]:
+        if tag.startswith('AS:i:'):
+            return int(tag[5:])
+    return 0
+
+def _group_score(records):
+    '''Score of a read in one shard: (number of mapped segments, total
+    alignment score of the primary alignments)'''
+    nmapped = 0
+    score = 0
+    for fields in records:
+        flag = int(fields[1])
+        if flag & 0x900 or flag & 0x4:
+            continue
+        nmapped += 1
+        score += _alignment_score(fields)
+    return nmapped, score
+
+def merge_sam(shard_sams, output):
+    '''Merge SAM files produced by mapping the same reads to different shards
+
+    For each read (or read pair), the alignments from the shard with the best
+    hits are kept. Mapped alignments from other shards which are equally good
+    are kept as secondary alignments and the mapping quality (MAPQ) of all
+    alignments of the read is then set to 0. Reads not mapped anywhere are
+    kept as unmapped (once).
+    '''
+    inputs = [open(s) for s in shard_sams]
+    try:
+        with open(output, 'w') as out:
+            headers = [[] for _ in inputs]
+            for ix, ifile in enumerate(inputs):
+                for line in ifile:
+                    if not line.startswith('@'):
+                        break
+                    headers[ix].append(line)
+                ifile.seek(0)
+            out.writelines(h for h in headers[0] if h.startswith('@HD'))
+            for hs in headers:
+                out.writelines(h for h in hs if h.startswith('@SQ'))
+            out.writelines(h for h in headers[0] if not h.startswith(('@HD', '@SQ')))
+
+            groups = [_read_groups(ifile) for ifile in inputs]
+            while True:
+                current = [next(g, None) for g in groups]
+                if all(c is None for c in current):
+                    break
+                if any(c is None for c in current) or len(set(c[0] for c in current)) != 1:
+                    raise ValueError("Shard SAM files are not in the same read order (found reads: {})".format(
+                                [(c[0] if c is not None else None) for c in current]))
+                scores = [_group_score(records) for _, records in current]
+                best = max(scores)
+                winner = scores.index(best)
+                ties = []
+                if best[0] != 0:
+                    ties = [ix for ix, sc in enumerate(scores) if ix != winner and sc == best]
+                for fields in current[winner][1]:
+                    if ties and not int(fields[1]) & 0x4:
+                        # The read maps equally well elsewhere, so the
+                        # per-shard mapping quality is meaningless
+                        fields[4] = '0'
+                    out.write('\t'.join(fields) + '\n')
+                for ix in ties:
+                    for fields in current[ix][1]:
+                        flag = int(fields[1])
+                        if flag & 0x4:
+                            continue
+                        if not flag & 0x800:
+                            fields[1] = str(flag | 0x100)
+                        fields[4] = '0'
+                        out.write('\t'.join(fields) + '\n')
+    finally:
+        for ifile in inputs:
+            ifile.close()
+
+
+def prepare_shards(fasta, nshards, shard_dir=None, verbose=True):
+    '''Split `fasta` into `shard_dir`, unless this was already done
+
+    Parameters
+    ----------
+    fasta : str
+    nshards : int
+    shard_dir : str, optional
+        Default: `<fasta>.shards<nshards>`
+    verbose : bool, optional
+
+    Returns
+    -------
+    shards : list of str
+        Paths of the shard files
+    '''
+    def read_shards():
+        with open(os.path.join(shard_dir, SHARDS_LIST)) as ifile:
+            return [os.path.join(shard_dir, line.strip()) for line in ifile if line.strip()]
+    if shard_dir is None:
+        shard_dir = '{}.shards{}'.format(fasta, nshards)
+    shard_list = os.path.join(shard_dir, SHARDS_LIST)
+    if os.path.exists(shard_list) and os.path.getmtime(shard_list) >= os.path.getmtime(fasta):
+        shards = read_shards()
+        if all(os.path.exists(s) for s in shards):
+            return shards
+    if os.path.exists(shard_dir):
+        if verbose:
+            print("Removing outdated shards in '{}'".format(shard_dir))
+        shutil.rmtree(shard_dir)
+    if verbose:
+        print("Splitting '{}' into {} shards (in '{}')".format(fasta, nshards, shard_dir))
+    # Split into a temporary directory which is then renamed, so that
+    # concurrent runs never see incomplete shards
+    tdir = tempfile.mkdtemp(prefix='.nglesspy-shards-', dir=(os.path.dirname(os.path.abspath(shard_dir))))
+    try:
+        shards = split_fasta(fasta, nshards, tdir)
+        with open(os.path.join(tdir, SHARDS_LIST), 'w') as output:
+            for s in shards:
+                output.write(os.path.basename(s) + '\n')
+        try:
+            os.rename(tdir, shard_dir)
+        except OSError:
+            # Another run created it in the meantime
+            if not os.path.exists(shard_list):
+                raise
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+    return read_shards()
+
+
+def map_sharded(input, fasta, output, nshards,
+                input_reverse=None, input_singles=None,
+                executor=None, ncpus=None, workdir=None, shard_dir=None,
+                auto_install=True, verbose=True, version='0.8'):
+    '''Map reads against a reference split into `nshards` pieces
+
+    Parameters
+    ----------
+    input : str
+        FastQ file (forward reads if `input_reverse` is given)
+    fasta : str
+        Reference FASTA file
+    output : str
+        Output file. If it is not a SAM file, ngless is used to convert it
+    nshards : int
+        Number of shards
+    input_reverse, input_singles : str, optional
+        Reverse and unpaired reads for paired-end data
+    executor : executor object, optional
+        Where to run the mapping jobs (see `ngless.executors`). By default, all
+        shards are mapped at the same time on the local machine (use an
+        `executors.PoolExecutor` to limit how many run at once, and thus the
+        memory used)
+    ncpus : int or str, optional
+        CPUs to use for each mapping job
+    workdir : str, optional
+        Directory for the intermediate results (default: a temporary
+        directory). It must be visible to all jobs
+    shard_dir : str, optional
+        Directory where the shards (and their indices) are kept (default:
+        `<fasta>.shards<nshards>`). It must be visible to all jobs
+    '''
+    from .batch import run_many
+    shards = prepare_shards(fasta, nshards, shard_dir, verbose=verbose)
+    tdir = tempfile.mkdtemp(prefix='nglesspy-sharded-', dir=workdir)
+    try:
+        scripts = []
+        shard_sams = []
+        for ix, shard in enumerate(shards):
+            sc = NGLess.NGLess(version)
+            e = sc.env
+            if input_reverse:
+                paired_args = {}
+                if input_singles:
+                    paired_args['singles'] = input_singles
+                e.input = sc.paired_(input, input_reverse, **paired_args)
+            else:
+                e.input = sc.fastq_(input)
+            e.mapped = sc.map_(e.input, fafile=shard)
+            shard_sams.append(os.path.join(tdir, 'shard{}.sam'.format(ix)))
+            sc.write_(e.mapped, ofile=shard_sams[-1])
+            scripts.append(sc)
+        run_many(scripts, executor=executor, auto_install=auto_install, verbose=verbose, ncpus=ncpus)
+
+        merged = (output if output.endswith('.sam') else os.path.join(tdir, 'merged.sam'))
+        if verbose:
+            print("Merging {} shard results".format(len(shard_sams)))
+        merge_sam(shard_sams, merged)
+        if merged != output:
+            sc = NGLess.NGLess(version)
+            e = sc.env
+            e.mapped = sc.samfile_(merged)
+            sc.write_(e.mapped, ofile=output)
+            sc.run(auto_install=False, verbose=verbose, ncpus=ncpus, executor=executor, history=False)
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
@@ -0,0 +1,198 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+'''
+Staging of inputs/outputs to local scratch space
+
+When running many scripts whose inputs are on slow (network) storage, the
+`Stager` copies the inputs of the next script(s) to local disk while the
+current one is running. Outputs are written to local disk and moved to their
+final location in the background.
+
+Example
+-------
+
+    from ngless import staging
+
+    scripts = [build_script(sample) for sample in samples]
+    staging.run_staged(scripts, scratch_dir='/scratch', max_bytes=200 * 2**30)
+'''
+
+import os
+import shutil
+import tempfile
+import threading
+
+class _DiskBudget(object):
+    '''Tracks how many bytes of scratch space are in use'''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def fits(self, nbytes):
+        return self.max_bytes is None or nbytes <= self.max_bytes
+
+    def reserve(self, nbytes, block=True):
+        with self.cond:
+            if block and self.max_bytes is not None:
+                while self.used + nbytes > self.max_bytes:
+                    self.cond.wait()
+            self.used += nbytes
+
+    def release(self, nbytes):
+        with self.cond:
+            self.used -= nbytes
+            self.cond.notify_all()
+
+
+class _StagedJob(object):
+    def __init__(self, script, workdir):
+        self.script = script
+        self.workdir = workdir
+        self.inputs = {}
+        self.outputs = {}
+        self.nbytes = 0
+        self.out_nbytes = 0
+
+
+class Stager(object):
+    '''Run scripts with their inputs & outputs on local scratch space
+
+    Parameters
+    ----------
+    scratch_dir : str, optional
+        Local directory to use (default: the system temporary directory)
+    max_bytes : int, optional
+        Maximum number of bytes of inputs and outputs that can be staged at any
+        given time (default: unlimited). Space for the outputs is reserved
+        along with the inputs, estimated as `output_ratio` times the size of
+        the inputs. If there is not enough space for the outputs, they are
+        written directly to their final location; if the inputs do not fit
+        either, the original files are used.
+    output_ratio : float, optional (default: 1)
+        Expected size of the outputs of a script relative to its inputs
+    prefetch : int, optional (default: 1)
+        How many scripts ahead to stage
+    nthreads : int, optional (default: 2)
+        Number of threads used to copy outputs back
+    verbose : bool, optional (default: True)
+    '''
+    def __init__(self, scratch_dir=None, max_bytes=None, prefetch=1, nthreads=2, verbose=True, output_ratio=1.):
+        self.scratch_dir = scratch_dir
+        self.budget = _DiskBudget(max_bytes)
+        self.output_ratio = output_ratio
+        self.prefetch = prefetch
+        self.nthreads = nthreads
+        self.verbose = verbose
+
+    def stage_in(self, script):
+        '''Copy inputs of `script` to scratch space (blocks if there is not
+        enough space available)'''
+        job = _StagedJob(script, tempfile.mkdtemp(prefix='nglesspy-stage-', dir=self.scratch_dir))
+        inputs = [f for f in set(script.input_files()) if os.path.isfile(f)]
+        nbytes = sum(os.path.getsize(f) for f in inputs)
+        outputs = sorted(set(script.output_files()))
+        out_nbytes = (int(self.output_ratio * nbytes) if outputs else 0)
+        try:
+            stage_outputs = self.budget.fits(nbytes + out_nbytes)
+            if stage_outputs or self.budget.fits(nbytes):
+                reserved = nbytes + (out_nbytes if stage_outputs else 0)
+                self.budget.reserve(reserved)
+                job.nbytes = reserved
+                job.out_nbytes = reserved - nbytes
+                for ix, f in enumerate(sorted(inputs)):
+                    target = os.path.join(job.workdir, 'in{}'.format(ix), os.path.basename(f))
+                    os.mkdir(os.path.dirname(target))
+                    if self.verbose:
+                        print("Staging '{}' to '{}'".format(f, target))
+                    shutil.copyfile(f, target)
+                    job.inputs[f] = target
+            elif self.verbose:
+                print("Inputs ({} bytes) do not fit in the staging area. Using original files.".format(nbytes))
+            if not stage_outputs:
+                if self.verbose and outputs:
+                    print("Outputs (~{} bytes) do not fit in the staging area. Writing them directly.".format(out_nbytes))
+                outputs = []
+            for ix, f in enumerate(outputs):
+                target = os.path.join(job.workdir, 'out{}'.format(ix), os.path.basename(f))
+                os.mkdir(os.path.dirname(target))
+                job.outputs[f] = (target, os.path.abspath(f))
+        except:
+            self.stage_out(job, success=False)
+            raise
+        return job
+
+    def stage_out(self, job, success=True):
+        '''Move outputs of `job` to their final location and clean up'''
+        try:
+            if success:
+                for target, final in job.outputs.values():
+                    if os.path.exists(target):
+                        if self.verbose:
+                            print("Moving '{}' to '{}'".format(target, final))
+                        shutil.move(target, final)
+        finally:
+            shutil.rmtree(job.workdir, ignore_errors=True)
+            self.budget.release(job.nbytes)
+
+    def run_job(self, job, **run_args):
+        '''Run an already staged job'''
+        mapping = dict(job.inputs)
+        for f, (target, _) in job.outputs.items():
+            mapping[f] = target
+        job.script.with_paths(mapping).run(**run_args)
+        # Replace the estimate (reserved in `stage_in`) by the actual size
+        nbytes = sum(os.path.getsize(target)
+                        for target, _ in job.outputs.values()
+                        if os.path.exists(target))
+        if nbytes > job.out_nbytes:
+            self.budget.reserve(nbytes - job.out_nbytes, block=False)
+        else:
+            self.budget.release(job.out_nbytes - nbytes)
+        job.nbytes += nbytes - job.out_nbytes
+        job.out_nbytes = nbytes
+
+    def run_all(self, scripts, **run_args):
+        '''Run all scripts (in order), overlapping staging with execution
+
+        Any extra arguments are passed to `NGLess.run`.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        scripts = list(scripts)
+        staged = []
+        consumed = 0
+        pending_out = []
+        # Separate pools so that a stage-in waiting for disk space never
+        # blocks the stage-outs which would free that space.
+        with ThreadPoolExecutor(1) as in_pool, ThreadPoolExecutor(self.nthreads) as out_pool:
+            try:
+                for ix in range(len(scripts)):
+                    while len(staged) <= min(ix + self.prefetch, len(scripts) - 1):
+                        staged.append(in_pool.submit(self.stage_in, scripts[len(staged)]))
+                    job = staged[ix].result()
+                    consumed = ix + 1
+                    try:
+                        self.run_job(job, **run_args)
+                    except:
+                        self.stage_out(job, success=False)
+                        raise
+                    pending_out.append(out_pool.submit(self.stage_out, job))
+            finally:
+                for f in staged[consumed:]:
+                    if not f.cancel() and f.exception() is None:
+                        self.stage_out(f.result(), success=False)
+                for f in pending_out:
+                    f.result()
+
+
+def run_staged(scripts, scratch_dir=None, max_bytes=None, prefetch=1, verbose=True, output_ratio=1., **run_args):
+    '''Run a list of scripts, staging inputs & outputs through local disk
+
+    See `Stager` for the meaning of the arguments. Other arguments are passed
+    to `NGLess.run`.
+    '''
+    Stager(scratch_dir=scratch_dir,
+            max_bytes=max_bytes,
+            prefetch=prefetch,
+            verbose=verbose,
+            output_ratio=output_ratio).run_all(scripts, verbose=verbose, **run_args)
@@ -0,0 +1,182 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+'''
+Validation of scripts before running them
+
+`validate_many` calls `ngless --validate-only` on many scripts in parallel, so
+that errors (e.g., a misspelled argument) are found before any job is
+launched. Results are cached (in memory) by the hash of the script text, so
+identical scripts are only validated once.
+
+Errors are returned as dictionaries with the keys
+
+- `message`: the error reported by ngless
+- `line`: line number in the generated script (None if unknown)
+- `code`: the NGLess code of the offending statement
+- `call_site`: `(filename, lineno)` of the Python code which created it
+
+Example
+-------
+
+    from ngless import validate
+
+    for sc, errors in zip(scripts, validate.validate_many(scripts)):
+        for err in errors:
+            print(validate.format_error(err))
+'''
+
+import hashlib
+import os
+import re
+import subprocess
+
+from . import NGLess as ngl
+
+_cache = {}
+
+_LINE_RE = re.compile(r'\bline (\d+)', re.IGNORECASE)
+
+class ValidationError(ValueError):
+    '''Some scripts failed validation
+
+    Attributes
+    ----------
+    errors : list of (int, list of dict)
+        Index of each invalid script and its errors
+    '''
+    def __init__(self, errors):
+        ValueError.__init__(self, '\n'.join(
+                'Script {}: {}'.format(ix, format_error(err))
+                    for ix, errs in errors
+                    for err in errs))
+        self.errors = errors
+
+
+def _statement_lines(sc):
+    '''Return a list with the statement generating each line of `sc.generate()`
+
+    Header lines correspond to None. Lines inside a block map to the
+    statement in the block (which may span several lines).
+    '''
+    lines = [None for _ in range(2 + len(sc.modules))]
+    for e in sc.script:
+        nlines = e.generate().count('\n') + 1
+        blocks = [b for b in ngl.walk(e) if isinstance(b, ngl.Block)]
+        inner = []
+        for st in (blocks[0].block if blocks else []):
+            inner.extend(st for _ in range(st.generate().count('\n') + 1))
+        for ix in range(nlines):
+            if 0 < ix <= len(inner):
+                lines.append(inner[ix - 1])
+            else:
+                lines.append(e)
+    return lines
+
+def _call_site(statement, message):
+    '''Call site of the call in `statement` which the error most likely refers to
+
+    Calls whose function name or argument names appear in the message are
+    preferred, otherwise the outermost call is used.
+    '''
+    calls = [c for c in ngl.walk(statement)
+                if isinstance(c, (ngl.FunctionCall, ngl.PairedCalled))
+                    and getattr(c, 'call_site', None) is not None]
+    if not calls:
+        return None
+    words = set(re.findall(r'\w+', message))
+    for c in calls:
+        names = set(c.kwargs.keys())
+        names.add(getattr(c, 'fname', 'paired'))
+        if names & words:
+            return c.call_site
+    return calls[0].call_site
+
+def parse_errors(sc, output):
+    '''Convert ngless' error output on `sc` into a list of error dictionaries'''
+    lines = _statement_lines(sc)
+    script_lines = sc.generate().split('\n')
+    errors = []
+    for message in output.splitlines():
+        match = _LINE_RE.search(message)
+        if match is None:
+            continue
+        line = int(match.group(1))
+        statement = (lines[line - 1] if 0 < line <= len(lines) else None)
+        errors.append({
+            'message': message.strip(),
+            'line': line,
+            'code': (script_lines[line - 1].strip() if 0 < line <= len(script_lines) else None),
+            'call_site': (_call_site(statement, message) if statement is not None else None),
+            })
+    if not errors:
+        errors.append({
+            'message': output.strip(),
+            'line': None,
+            'code': None,
+            'call_site': None,
+            })
+    return errors
+
+def format_error(err):
+    '''Format an error dictionary for printing'''
+    where = ''
+    if err['call_site'] is not None:
+        where = '{}:{}: '.format(*err['call_site'])
+    if err['code'] is not None:
+        return '{}{} (in `{}`)'.format(where, err['message'], err['code'])
+    return where + err['message']
+
+
+def _run_validation(script, extra_args):
+    from .executors import _write_script
+    script_name = _write_script(script)
+    try:
+        p = subprocess.Popen(ngl._ngless_cmdline(script_name, extra_args=['--validate-only'] + list(extra_args)),
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT)
+        output, _ = p.communicate()
+        return p.returncode, output.decode('utf-8', 'replace')
+    finally:
+        os.unlink(script_name)
+
+def validate_many(scripts, max_jobs=None, auto_install=True, verbose=False, extra_args=[]):
+    '''Validate scripts in parallel
+
+    Parameters
+    ----------
+    scripts : list of NGLess
+    max_jobs : int, optional
+        Maximum number of concurrent ngless processes (default: number of CPUs)
+    auto_install : bool, optional (default: True)
+        If true, then ngless is installed if not available in the PATH
+    extra_args : list of str, optional
+        Extra arguments to pass to ngless
+
+    Returns
+    -------
+    errors : list of list of dict
+        Errors for each script (an empty list if the script is valid)
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    if auto_install:
+        from . import install
+        install.install_ngless(verbose=verbose)
+    scripts = list(scripts)
+    texts = [sc.generate() for sc in scripts]
+    keys = [hashlib.sha1('\0'.join([t] + list(extra_args)).encode('utf-8')).hexdigest() for t in texts]
+    todo = {}
+    for k, t in zip(keys, texts):
+        if k not in _cache:
+            todo[k] = t
+    if todo:
+        if verbose:
+            print("Validating {} script(s) ({} cached)".format(len(todo), len(set(keys)) - len(todo)))
+        with ThreadPoolExecutor(max_jobs or os.cpu_count() or 1) as pool:
+            futures = dict((k, pool.submit(_run_validation, t, extra_args)) for k, t in todo.items())
+            for k, f in futures.items():
+                _cache[k] = f.result()
+    results = []
+    for sc, k in zip(scripts, keys):
+        returncode, output = _cache[k]
+        results.append(parse_errors(sc, output) if returncode != 0 else [])
+    return results
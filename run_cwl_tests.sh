@@ -15,6 +15,9 @@ for script in cwl/*.cwl; do
         "$script" "test-data/$(basename "${script%.*}".yml)" || { echo "Running $script failed"; let "FAILURES+=1"; }
 done
 
+# Chained scripts streaming through FIFOs (ngless.pipeline)
+python helpers/check_pipeline.py || { echo "Running helpers/check_pipeline.py failed"; let "FAILURES+=1"; }
+
 if [ "$FAILURES" != "0" ]; then
     echo "$FAILURES CWL tests failed"
     exit 1
@@ -0,0 +1,86 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+'''
+Check `ngless.batch.run_many` with the `LocalQueue` scheduler, using a stub
+`ngless` which copies its input to its output
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+
+from ngless import NGLess, batch, executors
+
+STUB_NGLESS = '''#!{python}
+import re
+import sys
+script = open(sys.argv[1]).read()
+if 'fail.fq' in script:
+    sys.exit(3)
+ifile = re.search(r'fastq\\("([^"]+)"', script).group(1)
+ofile = re.search(r'ofile="([^"]+)"', script).group(1)
+with open(ifile) as i, open(ofile, 'w') as o:
+    o.write(i.read())
+'''
+
+def build_script(ifile, ofile):
+    sc = NGLess.NGLess('0.8')
+    e = sc.env
+    e.input = sc.fastq_(ifile)
+    sc.write_(e.input, ofile=ofile)
+    return sc
+
+def _run(tdir, inputs, max_running=None):
+    bindir = os.path.join(tdir, 'bin')
+    os.mkdir(bindir)
+    with open(os.path.join(bindir, 'ngless'), 'w') as output:
+        output.write(STUB_NGLESS.format(python=sys.executable))
+    os.chmod(os.path.join(bindir, 'ngless'), 0o755)
+    workdir = os.path.join(tdir, 'work')
+    os.mkdir(workdir)
+
+    scripts = []
+    for ix, ifile in enumerate(inputs):
+        ifile = os.path.join(tdir, ifile)
+        with open(ifile, 'w') as output:
+            output.write('@read{0}\nACGT\n+\nIIII\n'.format(ix))
+        scripts.append(build_script(ifile, os.path.join(tdir, 'output{}.fq'.format(ix))))
+    queue = executors.LocalQueue(max_running)
+    executor = executors.BatchExecutor(queue, workdir=workdir, poll_interval=.05)
+    path = os.environ['PATH']
+    os.environ['PATH'] = bindir + os.pathsep + path
+    try:
+        batch.run_many(scripts, executor=executor, auto_install=False, verbose=False, history=False,
+                        resources={'memory': 2 ** 30})
+    finally:
+        os.environ['PATH'] = path
+        # All scripts are removed, whether the jobs succeed or not
+        assert os.listdir(workdir) == []
+        assert len(queue.resources) == len(inputs)
+        assert all(r == {'memory': 2 ** 30} for r in queue.resources.values())
+
+def test_run_many():
+    tdir = tempfile.mkdtemp()
+    try:
+        _run(tdir, ['input{}.fq'.format(ix) for ix in range(5)], max_running=2)
+        for ix in range(5):
+            with open(os.path.join(tdir, 'output{}.fq'.format(ix))) as ifile:
+                assert ifile.read() == '@read{0}\nACGT\n+\nIIII\n'.format(ix)
+    finally:
+        shutil.rmtree(tdir)
+
+def test_run_many_failures():
+    tdir = tempfile.mkdtemp()
+    try:
+        try:
+            _run(tdir, ['input0.fq', 'fail.fq', 'input2.fq'])
+        except batch.BatchError as e:
+            assert e.failed == [(1, 3)]
+        else:
+            assert False, 'BatchError not raised'
+        assert os.path.exists(os.path.join(tdir, 'output0.fq'))
+        assert not os.path.exists(os.path.join(tdir, 'output1.fq'))
+        assert os.path.exists(os.path.join(tdir, 'output2.fq'))
+    finally:
+        shutil.rmtree(tdir)
@@ -0,0 +1,67 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+
+import os
+import shutil
+import tempfile
+
+from ngless import NGLess, history
+
+def build_script(ifile, mapping=False):
+    sc = NGLess.NGLess('0.8')
+    e = sc.env
+    e.input = sc.fastq_(ifile)
+    if mapping:
+        e.input = sc.map_(e.input, reference='hg19')
+    sc.write_(e.input, ofile='output.sam')
+    return sc
+
+def test_tune():
+    tdir = tempfile.mkdtemp()
+    try:
+        ifile = os.path.join(tdir, 'input.fq')
+        with open(ifile, 'wb') as output:
+            output.write(b'@r\nACGT\n+\nIIII\n' * 1000)
+        sc = build_script(ifile)
+        h = history.RunHistory(os.path.join(tdir, 'subdir', 'history.sqlite'))
+        assert h.tune(sc) is None
+
+        # Throughput stops improving after 4 threads
+        for ncpus, wall_time, peak_rss in [
+                        (1, 80., 100),
+                        (2, 40., 200),
+                        (4, 20., 300),
+                        (4, 21., 350),
+                        (8, 19., 500),
+                        (8, 30., 600),
+                        (8, 19.5, 700),
+                        ]:
+            h.record(sc, ncpus, wall_time, peak_rss)
+        # Failed runs are ignored
+        h.record(sc, 16, 1., 10, success=False)
+        assert h.tune(sc) == (4, 350)
+        assert h.tune(sc, tolerance=1.) == (8, 700)
+        assert h.tune(sc, tolerance=.4) == (2, 200)
+
+        # Different shape
+        assert h.tune(build_script(ifile, mapping=True)) is None
+
+        # Much larger input
+        large = os.path.join(tdir, 'large.fq')
+        with open(large, 'wb') as output:
+            output.write(b'@r\nACGT\n+\nIIII\n' * 10000)
+        assert h.tune(build_script(large)) is None
+    finally:
+        shutil.rmtree(tdir)
+
+def test_tuned_resources():
+    tdir = tempfile.mkdtemp()
+    try:
+        sc = build_script(os.path.join(tdir, 'missing.fq'))
+        assert history.tuned_resources(sc, path=os.path.join(tdir, 'history.sqlite')) == ('auto', None)
+        assert history.tuned_resources(sc, path=os.path.join(tdir, 'history.sqlite'), default=2) == (2, None)
+        # The history cannot be opened
+        os.mkdir(os.path.join(tdir, 'directory.sqlite'))
+        assert history.tuned_resources(sc, path=os.path.join(tdir, 'directory.sqlite')) == ('auto', None)
+    finally:
+        shutil.rmtree(tdir)
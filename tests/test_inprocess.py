@@ -0,0 +1,152 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+'''
+Check `ngless.inprocess` against a simple (read by read) implementation of
+substrim/endstrim
+'''
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from ngless import NGLess, inprocess
+
+def substrim(qual, min_quality):
+    '''Longest run of good bases (the first one in case of ties)'''
+    best_start, best_len = 0, 0
+    cur_start, cur_len = 0, 0
+    for ix, q in enumerate(qual):
+        if q >= min_quality:
+            if cur_len == 0:
+                cur_start = ix
+            cur_len += 1
+            if cur_len > best_len:
+                best_start, best_len = cur_start, cur_len
+        else:
+            cur_len = 0
+    return best_start, best_len
+
+def endstrim(qual, min_quality, from_ends):
+    '''Remove bad bases from the ends'''
+    good = [ix for ix, q in enumerate(qual) if q >= min_quality]
+    if not good:
+        return 0, 0
+    first = (0 if from_ends == '{3}' else good[0])
+    last = (len(qual) - 1 if from_ends == '{5}' else good[-1])
+    return first, last - first + 1
+
+def reference(reads, offset, ops):
+    '''Apply `ops` to `reads` (a list of (name, seq, qual) strings)'''
+    output = []
+    for name, seq, qual in reads:
+        keep = True
+        for op in ops:
+            if op[0] == 'discard':
+                if op[1] == '<' and len(seq) < op[2]:
+                    keep = False
+                continue
+            fname, min_quality, from_ends = op
+            scores = [ord(c) - offset for c in qual]
+            if fname == 'substrim':
+                start, n = substrim(scores, min_quality)
+            else:
+                start, n = endstrim(scores, min_quality, from_ends)
+            seq = seq[start:start + n]
+            qual = qual[start:start + n]
+        if keep and seq:
+            output.append((name, seq, qual))
+    return output
+
+def random_reads(n, offset, seed=0):
+    rng = random.Random(seed)
+    reads = []
+    for ix in range(n):
+        length = rng.randint(0, 60)
+        seq = ''.join(rng.choice('ACGT') for _ in range(length))
+        # Mix of high and low quality stretches
+        qual = ''.join(chr(offset + (rng.randint(25, 40) if rng.random() < .8 else rng.randint(0, 15)))
+                        for _ in range(length))
+        reads.append(('read{}'.format(ix), seq, qual))
+    return reads
+
+def write_fastq(fname, reads):
+    with open(fname, 'w') as output:
+        for name, seq, qual in reads:
+            output.write('@{}\n{}\n+\n{}\n'.format(name, seq, qual))
+
+def read_fastq(fname):
+    with open(fname) as ifile:
+        lines = ifile.read().splitlines()
+    return [(lines[ix][1:], lines[ix + 1], lines[ix + 3]) for ix in range(0, len(lines), 4)]
+
+
+def _check(ops, encoding='{33}', offset=33):
+    try:
+        import numpy
+    except ImportError:
+        raise unittest.SkipTest('numpy is not installed')
+    tdir = tempfile.mkdtemp()
+    try:
+        reads = random_reads(2000, offset)
+        write_fastq(os.path.join(tdir, 'input.fq'), reads)
+        sc = NGLess.NGLess('0.8')
+        e = sc.env
+        e.input = sc.fastq_(os.path.join(tdir, 'input.fq'), encoding=encoding)
+
+        @sc.preprocess_(e.input, using='r')
+        def proc(bk):
+            for op in ops:
+                if op[0] == 'substrim':
+                    bk.r = sc.substrim_(bk.r, min_quality=op[1])
+                elif op[0] == 'endstrim':
+                    bk.r = sc.endstrim_(bk.r, min_quality=op[1], from_ends=op[2])
+                else:
+                    sc.if_(sc.len_(bk.r) < op[2],
+                            sc.discard_)
+        sc.write_(e.input, ofile=os.path.join(tdir, 'output.fq'))
+
+        assert inprocess.compile_script(sc)[0][2] == ops
+        inprocess.execute(sc, verbose=False)
+        assert read_fastq(os.path.join(tdir, 'output.fq')) == reference(reads, offset, ops)
+    finally:
+        shutil.rmtree(tdir)
+
+def test_substrim():
+    _check([('substrim', 20, '{both}')])
+
+def test_endstrim():
+    _check([('endstrim', 20, '{both}')])
+
+def test_endstrim_from_ends():
+    _check([('endstrim', 20, '{3}')])
+    _check([('endstrim', 20, '{5}')])
+
+def test_chained_and_discard():
+    _check([('endstrim', 10, '{both}'), ('substrim', 30, '{both}'), ('discard', '<', 15)])
+
+def test_solexa_encoding():
+    _check([('substrim', 20, '{both}')], encoding='{64}', offset=64)
+
+
+def test_unsupported():
+    for ifile, call in [
+                ('input.fq.xz', lambda sc, r: sc.substrim_(r, min_quality=20)),
+                ('input.fq', lambda sc, r: sc.substrim_(r)),
+                ('input.fq', lambda sc, r: sc.smoothtrim_(r, min_quality=20, window=4)),
+                ]:
+        sc = NGLess.NGLess('0.8')
+        e = sc.env
+        e.input = sc.fastq_(ifile)
+
+        @sc.preprocess_(e.input, using='r')
+        def proc(bk):
+            bk.r = call(sc, bk.r)
+        sc.write_(e.input, ofile='output.fq')
+        try:
+            inprocess.compile_script(sc)
+        except inprocess.UnsupportedScript:
+            pass
+        else:
+            assert False, 'UnsupportedScript not raised'
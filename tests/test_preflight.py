@@ -0,0 +1,72 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+
+import gzip
+import os
+import shutil
+import tempfile
+
+from ngless import preflight
+
+def fastq_data(n, suffix='', length=50):
+    return ''.join('@read{}{} comment\n{}\n+\n{}\n'.format(ix, suffix, 'A' * length, 'I' * length)
+                        for ix in range(n)).encode('ascii')
+
+def _write(tdir, fname, data):
+    fname = os.path.join(tdir, fname)
+    opener = (gzip.open if fname.endswith('.gz') else open)
+    with opener(fname, 'wb') as output:
+        output.write(data)
+    return fname
+
+def _raises_preflight(f, *args):
+    try:
+        f(*args)
+    except preflight.PreflightError:
+        return True
+    return False
+
+def test_inspect_fastq():
+    tdir = tempfile.mkdtemp()
+    try:
+        for fname in ['input.fq', 'input.fq.gz']:
+            stats = preflight.inspect_fastq(_write(tdir, fname, fastq_data(2500)))
+            assert stats['records'] == 2500
+            assert stats['read_length'] == 50.
+            assert stats['bases'] == 2500 * 50
+            assert stats['headers'][:2] == [b'@read0', b'@read1']
+            assert stats['last_header'] == b'@read2499'
+
+        assert preflight.inspect_fastq(_write(tdir, 'empty.fq', b''))['records'] == 0
+    finally:
+        shutil.rmtree(tdir)
+
+def test_inspect_fastq_errors():
+    tdir = tempfile.mkdtemp()
+    try:
+        data = fastq_data(10)
+        assert _raises_preflight(preflight.inspect_fastq, os.path.join(tdir, 'missing.fq'))
+        # Truncated in the middle of a record
+        assert _raises_preflight(preflight.inspect_fastq, _write(tdir, 'truncated.fq', data[:-20]))
+        # A whole number of lines, but not of records
+        assert _raises_preflight(preflight.inspect_fastq, _write(tdir, 'lines.fq', b'\n'.join(data.split(b'\n')[:-3])))
+        assert _raises_preflight(preflight.inspect_fastq, _write(tdir, 'fasta.fq', b'>seq\nACGT\n>seq2\nACGT\n'))
+    finally:
+        shutil.rmtree(tdir)
+
+def test_check_paired():
+    tdir = tempfile.mkdtemp()
+    try:
+        forward = _write(tdir, 'input.1.fq', fastq_data(100, '/1'))
+        reverse = _write(tdir, 'input.2.fq.gz', fastq_data(100, '/2'))
+        singles = _write(tdir, 'input.singles.fq', fastq_data(3))
+        stats = preflight.check_paired(forward, reverse, singles)
+        assert [s['records'] for s in stats] == [100, 100, 3]
+
+        assert _raises_preflight(preflight.check_paired, forward, _write(tdir, 'short.fq', fastq_data(99, '/2')))
+        swapped = fastq_data(100, '/2').split(b'\n')
+        swapped[0], swapped[4] = swapped[4], swapped[0]
+        assert _raises_preflight(preflight.check_paired, forward, _write(tdir, 'swapped.fq', b'\n'.join(swapped)))
+        assert _raises_preflight(preflight.check_paired, forward, reverse, os.path.join(tdir, 'missing.fq'))
+    finally:
+        shutil.rmtree(tdir)
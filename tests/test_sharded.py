@@ -0,0 +1,76 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+
+import os
+import shutil
+import tempfile
+
+from ngless import sharded
+
+def record(qname, flag, ref, mapq=60, score=None):
+    fields = [qname, str(flag), ref, '1', str(mapq), '4M', '*', '0', '0', 'ACGT', 'IIII']
+    if score is not None:
+        fields.append('AS:i:{}'.format(score))
+    return '\t'.join(fields)
+
+def _merge(shards):
+    tdir = tempfile.mkdtemp()
+    try:
+        sams = []
+        for ix, records in enumerate(shards):
+            sams.append(os.path.join(tdir, 'shard{}.sam'.format(ix)))
+            with open(sams[-1], 'w') as output:
+                output.write('@HD\tVN:1.0\n@SQ\tSN:ref{0}\tLN:100\n@PG\tID:ngless\n'.format(ix))
+                for r in records:
+                    output.write(r + '\n')
+        sharded.merge_sam(sams, os.path.join(tdir, 'merged.sam'))
+        with open(os.path.join(tdir, 'merged.sam')) as ifile:
+            return ifile.read().splitlines()
+    finally:
+        shutil.rmtree(tdir)
+
+def test_merge_headers():
+    merged = _merge([[], [], []])
+    assert merged == ['@HD\tVN:1.0', '@SQ\tSN:ref0\tLN:100', '@SQ\tSN:ref1\tLN:100', '@SQ\tSN:ref2\tLN:100', '@PG\tID:ngless']
+
+def test_merge_best():
+    merged = _merge([
+            [record('r1', 0, 'ref0', score=10), record('r2', 4, '*', mapq=0)],
+            [record('r1', 0, 'ref1', score=30), record('r2', 0, 'ref1', score=5)],
+            [record('r1', 4, '*', mapq=0), record('r2', 4, '*', mapq=0)],
+            ])
+    body = [line for line in merged if not line.startswith('@')]
+    assert body == [record('r1', 0, 'ref1', score=30), record('r2', 0, 'ref1', score=5)]
+
+def test_merge_ties():
+    merged = _merge([
+            [record('r1', 0, 'ref0', score=30), record('r2', 4, '*', mapq=0)],
+            [record('r1', 16, 'ref1', score=30), record('r2', 4, '*', mapq=0)],
+            ])
+    body = [line for line in merged if not line.startswith('@')]
+    assert body == [
+            record('r1', 0, 'ref0', mapq=0, score=30),
+            record('r1', 16 | 0x100, 'ref1', mapq=0, score=30),
+            # Unmapped everywhere: kept once
+            record('r2', 4, '*', mapq=0),
+            ]
+
+def test_merge_pairs():
+    # A pair mapped in both shards is preferred over a single mate
+    merged = _merge([
+            [record('r1', 0x41, 'ref0', score=40), record('r1', 0x85, '*', mapq=0)],
+            [record('r1', 0x41, 'ref1', score=20), record('r1', 0x81, 'ref1', score=20)],
+            ])
+    body = [line for line in merged if not line.startswith('@')]
+    assert body == [record('r1', 0x41, 'ref1', score=20), record('r1', 0x81, 'ref1', score=20)]
+
+def test_merge_order_mismatch():
+    try:
+        _merge([
+            [record('r1', 0, 'ref0', score=30), record('r2', 0, 'ref0', score=30)],
+            [record('r2', 0, 'ref1', score=30), record('r1', 0, 'ref1', score=30)],
+            ])
+    except ValueError:
+        pass
+    else:
+        assert False, 'ValueError not raised'
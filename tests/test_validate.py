@@ -0,0 +1,67 @@
+# Copyright (C) 2017-2020, Luis Pedro Coelho <luis@luispedro.org> and Renato Alves <ralves@embl.de>
+# vim: set ts=4 sts=4 sw=4 expandtab smartindent:
+
+from ngless import NGLess, validate
+
+def build_script():
+    sc = NGLess.NGLess('0.8')
+    e = sc.env
+    e.input = sc.fastq_('input.fq')
+
+    @sc.preprocess_(e.input, using='r')
+    def proc(bk):
+        bk.r = sc.substrim_(bk.r, min_quality=20)
+        sc.if_(sc.len_(bk.r) < 10,
+                sc.discard_)
+    e.mapped = sc.map_(e.input, reference='hg19')
+    sc.write_(e.mapped, ofile='output.sam')
+    return sc
+
+def _line_of(code):
+    '''Line (in this file) of the first call containing `code`'''
+    with open(__file__) as ifile:
+        for ix, line in enumerate(ifile):
+            if code in line:
+                return ix + 1
+
+def test_parse_errors():
+    sc = build_script()
+    lines = sc.generate().split('\n')
+    assert lines[4].strip() == 'r = substrim(r, min_quality=20)'
+    assert lines[6].strip() == 'discard'
+    output = '\n'.join([
+            'Exiting after fatal error while loading script',
+            'Script error at line 5: unknown argument min_quality',
+            'Error in line 7 (something wrong with discard)',
+            'Error on line 9: reference hg19 not found',
+            ])
+    errors = validate.parse_errors(sc, output)
+    assert [e['line'] for e in errors] == [5, 7, 9]
+    assert [e['code'] for e in errors] == ['r = substrim(r, min_quality=20)', 'discard', 'mapped = map(input, reference="hg19")']
+    sites = [e['call_site'] for e in errors]
+    assert all(s[0] == __file__ for s in sites)
+    assert [s[1] for s in sites] == [
+                _line_of('sc.substrim_'),
+                # `discard` is part of the `if` statement, which includes the
+                # call to `len`
+                _line_of('sc.if_(sc.len_'),
+                _line_of('sc.map_'),
+                ]
+    assert 'reference hg19 not found' in validate.format_error(errors[2])
+
+def test_parse_errors_no_line():
+    sc = build_script()
+    errors = validate.parse_errors(sc, 'ngless: out of memory\n')
+    assert errors == [{
+                'message': 'ngless: out of memory',
+                'line': None,
+                'code': None,
+                'call_site': None,
+                }]
+
+def test_parse_errors_out_of_range():
+    sc = build_script()
+    errors = validate.parse_errors(sc, 'Error on line 100')
+    assert errors[0]['line'] == 100
+    assert errors[0]['code'] is None
+    assert errors[0]['call_site'] is None